@@ -0,0 +1,185 @@
+import argparse
+import struct
+import zlib
+from itertools import islice
+import numpy as np
+from psgio import PSG_REGS, carry_forward
+
+# Binary dump: a header, then one uint8 column of register values per register and one
+# bit-packed column per register of the frames that wrote it, optionally zlib-compressed
+DUMP_MAGIC = b'AYDB'
+DUMP_VERSION = 1
+DUMP_HEADER = struct.Struct('<4sBBBxI')  # magic, version, flags, registers, frames
+FLAG_ZLIB = 0x01
+BINARY_SUFFIX = '.aydb'
+TEXT_SUFFIX = '.aydump'
+TEXT_CHUNK_FRAMES = 65536  # lines parsed or formatted at a time
+NOT_WRITTEN = b'_'
+TAB = ord('\t')
+NEWLINE = ord('\n')
+
+def encode_dump(states, written, compress=True):
+    n_frames, n_regs = states.shape
+    payload = np.concatenate((np.ascontiguousarray(states.T, dtype=np.uint8).ravel(),
+                              np.packbits(written.T, axis=1).ravel())).tobytes()
+    if compress:
+        payload = zlib.compress(payload)
+    return DUMP_HEADER.pack(DUMP_MAGIC, DUMP_VERSION, FLAG_ZLIB if compress else 0, n_regs, n_frames) + payload
+
+def decode_dump(data):
+    """(states, written) from an encode_dump image."""
+    magic, version, flags, n_regs, n_frames = DUMP_HEADER.unpack_from(data)
+    if magic != DUMP_MAGIC:
+        raise ValueError("Not a binary AY register dump")
+    if version != DUMP_VERSION:
+        raise ValueError(f"Unsupported binary dump version {version}")
+    payload = memoryview(data)[DUMP_HEADER.size:]
+    if flags & FLAG_ZLIB:
+        payload = zlib.decompress(payload)
+    payload = np.frombuffer(payload, dtype=np.uint8)
+    states = payload[:n_regs * n_frames].reshape(n_regs, n_frames).T.copy()
+    bits = payload[n_regs * n_frames:].reshape(n_regs, -1)
+    written = np.unpackbits(bits, axis=1, count=n_frames).T.astype(bool)
+    return states, written
+
+def write_dump(filename, states, written, compress=True):
+    with open(filename, 'wb') as f:
+        f.write(encode_dump(states, written, compress))
+
+def read_dump(filename):
+    with open(filename, 'rb') as f:
+        return decode_dump(f.read())
+
+def build_cell_table():
+    # Text of every register value, and of a cell that was not written, padded to 3 bytes
+    cells = [str(value).encode() for value in range(256)] + [NOT_WRITTEN]
+    table = np.zeros((len(cells), 3), dtype=np.uint8)
+    for i, cell in enumerate(cells):
+        table[i, :len(cell)] = list(cell)
+    return table, np.array([len(cell) for cell in cells])
+
+def parse_text_dump(text):
+    """(frame_values, written) for whole lines of a text dump given as bytes; frame_values is 0 where not written."""
+    data = np.frombuffer(text, dtype=np.uint8)
+    if b'\r' in text:
+        data = data[data != ord('\r')]
+    if len(data) and data[-1] != NEWLINE:
+        data = np.append(data, NEWLINE)
+    # Every cell ends in a tab or a newline and is up to three digits or a lone '_'
+    ends = np.flatnonzero((data == TAB) | (data == NEWLINE))
+    n_frames = int(np.count_nonzero(data[ends] == NEWLINE))
+    n_cols = len(ends) // max(n_frames, 1)
+    if n_frames and (len(ends) != n_frames * n_cols or np.any(data[ends[n_cols - 1::n_cols]] != NEWLINE)):
+        raise ValueError("Register dump lines differ in their number of cells")
+    starts = np.concatenate(([0], ends[:-1] + 1))
+    digits = data.astype(np.int16) - ord('0')
+    is_digit = (digits >= 0) & (digits <= 9)
+    values = np.zeros(len(ends), dtype=np.int16)
+    n_digits = np.zeros(len(ends), dtype=np.int16)
+    in_number = np.ones(len(ends), dtype=bool)
+    for place in (1, 10, 100):
+        at = ends - n_digits - 1
+        in_number &= (at >= starts) & is_digit[np.maximum(at, 0)]
+        values += np.where(in_number, digits[np.maximum(at, 0)] * place, 0)
+        n_digits += in_number
+    written = n_digits > 0
+    length = ends - starts
+    unwritten = (length == 1) & (data[np.maximum(ends - 1, 0)] == NOT_WRITTEN[0])
+    bad = ~((written & (n_digits == length) & (values <= 255)) | unwritten)
+    if np.any(bad):
+        raise ValueError(f"Bad register dump cell in line {np.flatnonzero(bad)[0] // n_cols + 1}")
+    frame_values = np.zeros((n_frames, max(n_cols, PSG_REGS)), dtype=np.uint8)
+    frame_mask = np.zeros((n_frames, max(n_cols, PSG_REGS)), dtype=bool)
+    frame_values[:, :n_cols] = values.reshape(n_frames, n_cols)
+    frame_mask[:, :n_cols] = written.reshape(n_frames, n_cols)
+    return frame_values[:, :PSG_REGS], frame_mask[:, :PSG_REGS]
+
+def format_text_dump(states, written):
+    """The text dump lines for (states, written), as bytes."""
+    codes = np.where(written, states.astype(np.int16), len(CELL_TEXT) - 1)
+    n_frames, n_cols = codes.shape
+    cells = np.empty((n_frames, n_cols, 4), dtype=np.uint8)
+    cells[:, :, :3] = CELL_TEXT[codes]
+    cells[:, :, 3] = TAB
+    cells[:, -1:, 3] = NEWLINE
+    keep = np.ones((n_frames, n_cols, 4), dtype=bool)
+    keep[:, :, :3] = np.arange(3) < CELL_LENGTH[codes][:, :, None]
+    return cells[keep].tobytes()
+
+def iter_text_dump(filename, chunk_frames=TEXT_CHUNK_FRAMES):
+    """Yields (states, written) for chunk_frames lines at a time, so dumps of any length parse in bounded memory."""
+    state = None
+    with open(filename, 'rb') as file:
+        while True:
+            lines = list(islice(file, chunk_frames))
+            if not lines:
+                break
+            frame_values, written = parse_text_dump(b''.join(lines))
+            states = carry_forward(frame_values, written, state)
+            state = states[-1]
+            yield states, written
+
+def read_text_dump(filename):
+    return concatenate_chunks(iter_text_dump(filename))
+
+def write_text_chunks(filename, chunks):
+    with open(filename, 'wb') as file:
+        for states, written in chunks:
+            file.write(format_text_dump(states, written))
+
+def write_text_dump(filename, states, written, chunk_frames=TEXT_CHUNK_FRAMES):
+    write_text_chunks(filename, ((states[i:i + chunk_frames], written[i:i + chunk_frames]) for i in range(0, len(states), chunk_frames)))
+
+def concatenate_chunks(chunks):
+    chunks = list(chunks)
+    if not chunks:
+        return np.zeros((0, PSG_REGS), dtype=np.uint8), np.zeros((0, PSG_REGS), dtype=bool)
+    return np.concatenate([states for states, _ in chunks]), np.concatenate([written for _, written in chunks])
+
+CELL_TEXT, CELL_LENGTH = build_cell_table()
+
+def optimize_chunks(chunks):
+    """Yields the (states, written) chunks with every write but R13's dropped where the previous frame wrote the same value."""
+    previous_states = np.zeros(PSG_REGS, dtype=np.uint8)
+    previous_written = np.zeros(PSG_REGS, dtype=bool)
+    for states, written in chunks:
+        if len(states) == 0:
+            continue
+        before_states = np.vstack((previous_states, states[:-1]))
+        before_written = np.vstack((previous_written, written[:-1]))
+        repeated = written & before_written & (states == before_states)
+        repeated[:, 13] = False
+        previous_states, previous_written = states[-1], written[-1]
+        yield states, written & ~repeated
+
+def is_binary_dump(filename):
+    with open(filename, 'rb') as f:
+        return f.read(len(DUMP_MAGIC)) == DUMP_MAGIC
+
+def load_dump(filename):
+    """(states, written) from a register dump in either the binary or the text format."""
+    if is_binary_dump(filename):
+        return read_dump(filename)
+    return read_text_dump(filename)
+
+def iter_dump(filename, chunk_frames=TEXT_CHUNK_FRAMES):
+    """Like iter_text_dump, but also takes binary dumps, which come as one chunk."""
+    if is_binary_dump(filename):
+        yield read_dump(filename)
+    else:
+        yield from iter_text_dump(filename, chunk_frames)
+
+def main(input_filename, output_filename=None, compress=True):
+    states, written = load_dump(input_filename)
+    if is_binary_dump(input_filename):
+        write_text_dump(output_filename or input_filename + TEXT_SUFFIX, states, written)
+    else:
+        write_dump(output_filename or input_filename + BINARY_SUFFIX, states, written, compress)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Convert an AY register dump between the text and the binary format.')
+    parser.add_argument('input_filename', nargs='?', default='sync.psg.aydump', help='The input dump, text or binary (default: sync.psg.aydump)')
+    parser.add_argument('output_filename', nargs='?', help=f'The output dump (default: input_filename{BINARY_SUFFIX} for text input, input_filename{TEXT_SUFFIX} for binary input)')
+    parser.add_argument('--no-compress', action='store_true', help='Store the binary dump uncompressed')
+    args = parser.parse_args()
+    main(args.input_filename, args.output_filename, not args.no_compress)
@@ -2,14 +2,36 @@ import numpy as np
 import wave
 import os
 
+CHUNK_SIZE = 16384  # samples per block when streaming to disk
+
+FIR_TAPS_PER_PHASE = 16  # decimation filter length is this times the oversampling factor
+
+# Everything get_state() saves, in order; the FIR history follows these
+CHANNEL_STATE = ('tone_period', 'tone_counter', 'tone_output', 'volume', 't_off', 'n_off', 'e_on')
+CHIP_STATE = ('noise_register', 'noise_counter', 'noise_period', 'envelope_counter', 'envelope_step', 'envelope_shape', 'envelope_period')
+
 class Ayumi:
-    def __init__(self, dac_type='AY', panning=(1.0, 1.0), sample_rate=44100, clock_frequency=1750000):
+    def __init__(self, dac_type='AY', panning=(1.0, 1.0), sample_rate=44100, clock_frequency=1750000, oversample=1):
+        self.dac_type = dac_type
         self.dac_table = AY_DAC_TABLE if dac_type == 'AY' else YM_DAC_TABLE
         self.channels = [self.create_channel() for _ in range(3)]
         self.panning = panning
         self.sample_rate = sample_rate
         self.clock_frequency = clock_frequency  # Clock frequency in Hz
+        # The chip core runs oversample times faster than the output and is decimated
+        # back down; 'clock' picks the multiple closest to the chip's own clock / 8 rate
+        if oversample == 'clock':
+            oversample = max(1, round(clock_frequency / (8 * sample_rate)))
+        self.oversample = oversample
+        self.core_rate = sample_rate * oversample
+        self.fir = design_decimation_filter(oversample)
+        self.fir_reversed = self.fir[::-1].copy()
+        self.fir_history = np.zeros((3, len(self.fir) - oversample))
+        self.envelope_dac = np.asarray(self.dac_table)[ENVELOPE_SHAPES]
+        self.ramp = np.zeros(0, dtype=np.int64)
         self.noise_register = 0x01FFFF  # 17-bit LFSR
+        self.noise_counter = 0
+        self.noise_period = 0
         self.envelope_counter = 0
         self.envelope_step = 0
         self.envelope_shape = 0
@@ -21,6 +43,9 @@ class Ayumi:
             'tone_counter': 0,
             'tone_output': 0,
             'volume': 0.1,  # Default volume
+            't_off': 0,  # Mixer bits, as in R7 and the volume registers
+            'n_off': 1,
+            'e_on': 0,
         }
 
     def set_tone(self, channel_index, period):
@@ -29,32 +54,61 @@ class Ayumi:
     def set_noise(self, period):
         self.noise_period = period
 
+    def set_mixer(self, channel_index, t_off, n_off, e_on):
+        ch = self.channels[channel_index]
+        ch['t_off'] = t_off & 1
+        ch['n_off'] = n_off & 1
+        ch['e_on'] = e_on & 1
+
+    def set_volume(self, channel_index, volume):
+        # 4-bit register volume, mapped onto the odd steps of the 32-step DAC table
+        self.channels[channel_index]['volume'] = (2 * (volume & 0x0f) + 1) / (len(self.dac_table) - 1)
+
     def set_envelope(self, shape, period):
-        self.envelope_shape = shape
+        self.envelope_shape = shape & 0x0f
         self.envelope_period = period
         self.envelope_counter = 0
         self.envelope_step = 0
 
+    def set_envelope_period(self, period):
+        # Unlike set_envelope this does not restart the envelope, same as writing R11/R12 only
+        self.envelope_period = period
+
     def update_tone(self):
+        # tone_counter counts clock cycles scaled by core_rate, so the
+        # phase stays exact no matter how the samples are split into blocks
         for ch in self.channels:
             if ch['tone_period'] > 0:
-                increment = self.clock_frequency / (16 * ch['tone_period'] * self.sample_rate)
-                ch['tone_counter'] += increment
-                if ch['tone_counter'] >= 1:
-                    ch['tone_counter'] -= 1
-                    ch['tone_output'] = 1 - ch['tone_output']
+                threshold = 8 * ch['tone_period'] * self.core_rate
+                ch['tone_counter'] += self.clock_frequency
+                if ch['tone_counter'] >= threshold:
+                    flips, ch['tone_counter'] = divmod(ch['tone_counter'], threshold)
+                    ch['tone_output'] ^= flips & 1
 
     def update_noise(self):
-        bit0 = self.noise_register & 1
-        bit14 = (self.noise_register >> 14) & 1
-        feedback = bit0 ^ bit14
-        self.noise_register = (self.noise_register >> 1) | (feedback << 16)
+        # The LFSR shifts every 16 * period clock cycles; NOISE_STATES replaces the bit twiddling
+        threshold = 16 * max(self.noise_period, 1) * self.core_rate
+        self.noise_counter += self.clock_frequency
+        if self.noise_counter >= threshold:
+            steps, self.noise_counter = divmod(self.noise_counter, threshold)
+            self.noise_register = int(NOISE_STATES[(NOISE_INDEX[self.noise_register] + steps) % NOISE_CYCLE])
 
     def update_envelope(self):
-        self.envelope_counter += 1
-        if self.envelope_counter >= self.envelope_period:
-            self.envelope_counter = 0
-            self.envelope_step = (self.envelope_step + 1) % 32  # Adjust according to shape specifics
+        # One of the 32 envelope steps every 8 * period clock cycles, counted like tone_counter
+        threshold = 8 * max(self.envelope_period, 1) * self.core_rate
+        self.envelope_counter += self.clock_frequency
+        if self.envelope_counter >= threshold:
+            steps, self.envelope_counter = divmod(self.envelope_counter, threshold)
+            self.envelope_step = int(self.envelope_position(self.envelope_step + steps))
+
+    def envelope_position(self, step):
+        # Continuing shapes loop over both segments, the others stay on the held second segment
+        if ENVELOPE_LOOPS[self.envelope_shape]:
+            return step % ENVELOPE_LENGTH
+        return np.minimum(step, ENVELOPE_LENGTH - 1)
+
+    def envelope_level(self):
+        return int(ENVELOPE_SHAPES[self.envelope_shape, self.envelope_step])
 
     def process_sound(self):
         self.update_tone()
@@ -64,42 +118,270 @@ class Ayumi:
         left_output = np.array([0.0])
         right_output = np.array([0.0])
         for ch in self.channels:
-            volume_index = int(ch['volume'] * (len(self.dac_table) - 1))
-            if volume_index >= len(self.dac_table):
-                volume_index = len(self.dac_table) - 1
-            elif volume_index < 0:
-                volume_index = 0
-            dac_output = self.dac_table[volume_index] * ch['tone_output']
+            if ch['e_on']:
+                volume_index = self.envelope_level()
+            else:
+                volume_index = self.volume_index(ch)
+            output = (ch['tone_output'] | ch['t_off']) & ((self.noise_register & 1) | ch['n_off'])
+            dac_output = self.dac_table[volume_index] * output
             left_output += dac_output * self.panning[0]
             right_output += dac_output * self.panning[1]
         return np.stack((left_output, right_output), axis=-1).flatten().astype(np.float32)
 
+    def volume_index(self, ch):
+        return min(max(int(ch['volume'] * (len(self.dac_table) - 1)), 0), len(self.dac_table) - 1)
+
+    def ensure_workspace(self, num_samples):
+        # Scratch arrays for rendering num_samples output samples. They only ever grow,
+        # so rendering blocks of a steady size allocates no arrays at all.
+        history = self.fir_history.shape[1]
+        core_samples = num_samples * self.oversample
+        if core_samples <= len(self.ramp):
+            return
+        capacity = max(core_samples, 2 * len(self.ramp))
+        self.ramp = np.arange(1, capacity + 1, dtype=np.int64)
+        self.counters = np.empty(capacity, dtype=np.int64)
+        self.tone = np.empty(capacity, dtype=np.uint8)
+        self.noise = np.empty(capacity, dtype=np.uint8)
+        self.envelope = np.empty(capacity)
+        self.core = np.empty((3, history + capacity))
+        self.decimated = np.empty((3, capacity // self.oversample + 1))
+        self.mix_buffer = np.empty((3, capacity // self.oversample + 1))
+        # Every FIR window of the core buffer that lands on an output sample
+        self.windows = np.lib.stride_tricks.sliding_window_view(self.core, len(self.fir), axis=-1)[:, ::self.oversample]
+
+    def counter_steps(self, counter, threshold, num_samples):
+        # How many times a counter starting at counter has wrapped after each of the next num_samples samples
+        steps = self.counters[:num_samples]
+        np.multiply(self.ramp[:num_samples], self.clock_frequency, out=steps)
+        steps += counter
+        steps //= threshold
+        return steps
+
+    def render_tone(self, ch, num_samples):
+        output = self.tone[:num_samples]
+        if ch['tone_period'] <= 0:
+            output.fill(ch['tone_output'])
+            return output
+        flips = self.counter_steps(ch['tone_counter'], 8 * ch['tone_period'] * self.core_rate, num_samples)
+        flips &= 1
+        np.bitwise_xor(flips, ch['tone_output'], out=output, casting='unsafe')
+        self.advance_tone(ch, num_samples)
+        return output
+
+    def advance_tone(self, ch, num_samples):
+        if ch['tone_period'] <= 0:
+            return
+        threshold = 8 * ch['tone_period'] * self.core_rate
+        flips, ch['tone_counter'] = divmod(ch['tone_counter'] + self.clock_frequency * num_samples, threshold)
+        ch['tone_output'] ^= flips & 1
+
+    def advance_noise(self, num_samples):
+        threshold = 16 * max(self.noise_period, 1) * self.core_rate
+        steps, self.noise_counter = divmod(self.noise_counter + self.clock_frequency * num_samples, threshold)
+        self.noise_register = int(NOISE_STATES[(NOISE_INDEX[self.noise_register] + steps) % NOISE_CYCLE])
+
+    def render_noise(self, num_samples):
+        positions = self.counter_steps(self.noise_counter, 16 * max(self.noise_period, 1) * self.core_rate, num_samples)
+        positions += NOISE_INDEX[self.noise_register]
+        positions %= NOISE_CYCLE
+        output = np.take(NOISE_BITS, positions, out=self.noise[:num_samples])
+        self.advance_noise(num_samples)
+        return output
+
+    def advance_envelope(self, num_samples):
+        threshold = 8 * max(self.envelope_period, 1) * self.core_rate
+        steps, self.envelope_counter = divmod(self.envelope_counter + self.clock_frequency * num_samples, threshold)
+        self.envelope_step = int(self.envelope_position(self.envelope_step + steps))
+
+    def render_envelope(self, num_samples):
+        # DAC output of the envelope for each sample
+        positions = self.counter_steps(self.envelope_counter, 8 * max(self.envelope_period, 1) * self.core_rate, num_samples)
+        positions += self.envelope_step
+        if ENVELOPE_LOOPS[self.envelope_shape]:
+            positions %= ENVELOPE_LENGTH
+        else:
+            np.minimum(positions, ENVELOPE_LENGTH - 1, out=positions)
+        output = np.take(self.envelope_dac[self.envelope_shape], positions, out=self.envelope[:num_samples])
+        self.advance_envelope(num_samples)
+        return output
+
+    def render_block(self, num_samples):
+        """Renders num_samples stereo samples at once, same output as calling process_sound() num_samples times.
+
+        With oversampling, process_sound() is one core step and every output sample
+        is decimated from oversample of them."""
+        return self.render_into(np.empty((max(num_samples, 0), 2), dtype=np.float32))
+
+    def render_stems(self, num_samples):
+        """Renders the stereo mix and the three channels separately from one pass.
+
+        Returns (mix, stems): mix is what render_block() would return, stems is an
+        (n, 3) array with the unpanned DAC output of channels A, B and C."""
+        mix = np.empty((max(num_samples, 0), 2), dtype=np.float32)
+        stems = np.empty((max(num_samples, 0), 3), dtype=np.float32)
+        self.render_into(mix, stems)
+        return mix, stems
+
+    def render_into(self, out, stems=None):
+        """Renders len(out) samples into out, a preallocated float32 (n, 2) array or any
+        writable buffer of interleaved stereo float32 samples; returns out as an array.
+
+        stems, if given, receives the (n, 3) channel outputs as render_stems() does. Apart
+        from growing the scratch arrays to the largest block seen, this allocates no arrays,
+        so a caller pulling same-sized blocks renders without creating garbage."""
+        out = sample_view(out, 2)
+        num_samples = len(out)
+        if num_samples == 0:
+            return out
+        channels = self.render_channels(num_samples)
+        left_output, right_output, scratch = self.mix_buffer[:, :num_samples]
+        left_output.fill(0.0)
+        right_output.fill(0.0)
+        for output in channels:
+            left_output += np.multiply(output, self.panning[0], out=scratch)
+            right_output += np.multiply(output, self.panning[1], out=scratch)
+        np.copyto(out[:, 0], left_output, casting='same_kind')
+        np.copyto(out[:, 1], right_output, casting='same_kind')
+        if stems is not None:
+            np.copyto(sample_view(stems, 3), channels.T, casting='same_kind')
+        return out
+
+    def render_channels(self, num_samples):
+        # (3, num_samples) view into the workspace, valid until the next render
+        self.ensure_workspace(num_samples)
+        if self.oversample == 1:
+            channels = self.core[:, :num_samples]
+            self.render_core(num_samples, channels)
+            return channels
+        self.render_history(num_samples * self.oversample)
+        # Polyphase decimation: only every oversample-th filter output is computed, each as
+        # one dot product over a fixed window of core samples, so the result does not
+        # depend on how a render is split into blocks
+        return np.matmul(self.windows[:, :num_samples], self.fir_reversed, out=self.decimated[:, :num_samples])
+
+    def render_history(self, num_samples):
+        # Renders num_samples core samples behind the FIR history in the workspace,
+        # then keeps the newest ones as the history for the next block
+        history = self.fir_history.shape[1]
+        buffer = self.core[:, :history + num_samples]
+        buffer[:, :history] = self.fir_history
+        self.render_core(num_samples, buffer[:, history:])
+        self.fir_history[:] = buffer[:, num_samples:]
+        return buffer
+
+    def render_core(self, num_samples, channels):
+        # Fills channels with one row of DAC output per channel, at the core rate
+        if any(ch['e_on'] for ch in self.channels):
+            envelope = self.render_envelope(num_samples)
+        else:
+            envelope = None
+            self.advance_envelope(num_samples)
+        if not all(ch['n_off'] for ch in self.channels):
+            noise = self.render_noise(num_samples)
+        else:
+            noise = None
+            self.advance_noise(num_samples)
+        for i, ch in enumerate(self.channels):
+            tone = self.render_tone(ch, num_samples)
+            tone |= ch['t_off']
+            if not ch['n_off']:
+                tone &= noise
+            if ch['e_on']:
+                dac_output = envelope
+            else:
+                dac_output = self.dac_table[self.volume_index(ch)]
+            np.multiply(tone, dac_output, out=channels[i])
+
+    def advance(self, num_samples):
+        """Moves the chip num_samples output samples ahead without rendering them.
+
+        Ends in exactly the state render_block(num_samples) would leave; only the core
+        samples still needed by the decimation filter are actually rendered."""
+        history = self.fir_history.shape[1]
+        skipped = max(num_samples * self.oversample - history, 0)
+        for ch in self.channels:
+            self.advance_tone(ch, skipped)
+        self.advance_noise(skipped)
+        self.advance_envelope(skipped)
+        if history:
+            rendered = num_samples * self.oversample - skipped
+            # Sized for the core samples rendered, so a long skip does not grow the workspace
+            self.ensure_workspace(-(-rendered // self.oversample))
+            self.render_history(rendered)
+
+    def get_state(self):
+        """Returns the full chip state as one flat float64 array; every counter fits in it exactly."""
+        values = [ch[key] for ch in self.channels for key in CHANNEL_STATE]
+        values += [getattr(self, key) for key in CHIP_STATE]
+        return np.concatenate((np.array(values, dtype=np.float64), self.fir_history.ravel()))
+
+    def set_state(self, state):
+        """Restores a state from get_state() of an Ayumi with the same settings."""
+        position = 0
+        for ch in self.channels:
+            for key in CHANNEL_STATE:
+                ch[key] = float(state[position]) if key == 'volume' else int(state[position])
+                position += 1
+        for key in CHIP_STATE:
+            setattr(self, key, int(state[position]))
+            position += 1
+        self.fir_history[:] = np.reshape(state[position:], self.fir_history.shape)
+
     def generate_sound(self, duration_seconds):
         num_samples = int(self.sample_rate * duration_seconds)
-        all_samples = np.zeros((num_samples, 2), dtype=np.float32)
+        return self.render_block(num_samples)
 
-        for i in range(num_samples):
-            all_samples[i] = self.process_sound()
-
-        return all_samples
+    def generate_chunks(self, duration_seconds, chunk_size=CHUNK_SIZE):
+        num_samples = int(self.sample_rate * duration_seconds)
+        for start in range(0, num_samples, chunk_size):
+            yield self.render_block(min(chunk_size, num_samples - start))
 
-    def save_to_wav(self, filename, duration_seconds):
+    def save_to_wav(self, filename, duration_seconds, chunk_size=None):
         # Ensure the directory exists
         directory = os.path.dirname(filename)
-        if not os.path.exists(directory):
+        if directory and not os.path.exists(directory):
             os.makedirs(directory, exist_ok=True)
 
-        samples = self.generate_sound(duration_seconds)
+        # With chunk_size set, memory stays at one chunk however long the render is
+        if chunk_size:
+            blocks = self.generate_chunks(duration_seconds, chunk_size)
+        else:
+            blocks = [self.generate_sound(duration_seconds)]
         try:
-            with wave.open(filename, 'w') as wav_file:
-                wav_file.setnchannels(2)
-                wav_file.setsampwidth(2)
-                wav_file.setframerate(self.sample_rate)
-                wav_file.writeframes((samples * 32767).astype(np.int16).tobytes())
+            write_wav(filename, blocks, self.sample_rate)
             print(f"Successfully saved to {filename}")
         except Exception as e:
             print(f"Failed to save the WAV file: {e}")
 
+def sample_view(buffer, channels):
+    # (n, channels) float32 array over a caller's buffer, without copying it
+    if isinstance(buffer, np.ndarray):
+        # Reinterpreting another dtype or layout would render garbage into it
+        if buffer.dtype != np.float32:
+            raise TypeError(f"Sample buffer must be float32, not {buffer.dtype}")
+        if buffer.ndim != 2 or buffer.shape[1] != channels or not buffer.flags.c_contiguous:
+            raise ValueError(f"Sample buffer must be a C-contiguous (n, {channels}) array, not {buffer.shape}")
+        return buffer
+    return np.frombuffer(buffer, dtype=np.float32).reshape(-1, channels)
+
+def open_wav(filename, sample_rate, channels=2):
+    wav_file = wave.open(filename, 'w')
+    wav_file.setnchannels(channels)
+    wav_file.setsampwidth(2)
+    wav_file.setframerate(sample_rate)
+    return wav_file
+
+def to_pcm16(samples):
+    # Three full-volume channels can sum past 1.0, clip rather than wrap around
+    return (np.clip(samples, -1.0, 1.0) * 32767).astype(np.int16).tobytes()
+
+def write_wav(filename, blocks, sample_rate, channels=2):
+    """Writes an iterable of (n, channels) float sample blocks to a 16-bit WAV file, one block at a time."""
+    with open_wav(filename, sample_rate, channels) as wav_file:
+        for samples in blocks:
+            wav_file.writeframes(to_pcm16(samples))
+
 # Define DAC tables with realistic data from hardware specifications
 # AY_DAC_TABLE = [0.0, 0.5, 1.0]  # Simplified DAC values
 # YM_DAC_TABLE = [0.0, 0.75, 1.0]  # Simplified DAC values
@@ -140,10 +422,56 @@ YM_DAC_TABLE = [
     0.879926756695, 1.0
 ]
 
+def build_noise_tables():
+    # Walk the full 17-bit LFSR cycle once so any number of steps is a table lookup
+    states = np.zeros(NOISE_CYCLE, dtype=np.int32)
+    index = np.zeros(1 << 17, dtype=np.int64)
+    register = 0x01FFFF
+    for i in range(NOISE_CYCLE):
+        states[i] = register
+        index[register] = i
+        feedback = (register ^ (register >> 14)) & 1
+        register = (register >> 1) | (feedback << 16)
+    return states, index
+
+NOISE_CYCLE = 131071
+NOISE_STATES, NOISE_INDEX = build_noise_tables()
+NOISE_BITS = (NOISE_STATES & 1).astype(np.uint8)
+
+def design_decimation_filter(oversample):
+    # Kaiser-windowed sinc low-pass just below the output Nyquist frequency
+    if oversample == 1:
+        return np.ones(1)
+    length = FIR_TAPS_PER_PHASE * oversample
+    cutoff = 0.45 / oversample
+    t = np.arange(length) - (length - 1) / 2
+    taps = 2 * cutoff * np.sinc(2 * cutoff * t) * np.kaiser(length, 8.0)
+    return taps / taps.sum()
+
+def build_envelope_tables():
+    # Each R13 shape is two 32-step segments; the second one either holds or repeats
+    down = np.arange(31, -1, -1)
+    up = np.arange(32)
+    bottom = np.zeros(32, dtype=np.int64)
+    top = np.full(32, 31)
+    segments = [
+        (down, bottom), (down, bottom), (down, bottom), (down, bottom),
+        (up, bottom), (up, bottom), (up, bottom), (up, bottom),
+        (down, down), (down, bottom), (down, up), (down, top),
+        (up, up), (up, top), (up, down), (up, bottom),
+    ]
+    shapes = np.array([np.concatenate(pair) for pair in segments], dtype=np.uint8)
+    loops = np.array([shape in (8, 10, 12, 14) for shape in range(16)])
+    return shapes, loops
+
+ENVELOPE_LENGTH = 64
+ENVELOPE_SHAPES, ENVELOPE_LOOPS = build_envelope_tables()
+
 # Example usage
 if __name__ == "__main__":
     ayumi = Ayumi(dac_type='AY', panning=(0.5, 0.5), sample_rate=44100, clock_frequency=1750000)
     ayumi.set_tone(0, 512)  # Set tone frequency for channel 0
-    ayumi.set_envelope(14, 32)  # Set tone frequency for channel 0
+    ayumi.set_mixer(0, 0, 1, 1)  # Tone on, noise off, volume from the envelope
+    ayumi.set_envelope(14, 32)  # Triangle envelope
     output_path = "./output.wav"  # Adjusted to a likely valid path
     ayumi.save_to_wav(output_path, 5)  # Generate a 5 second WAV file
\ No newline at end of file
@@ -0,0 +1,124 @@
+import argparse
+import hashlib
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import aydump
+import chip2psg
+import dump2chip
+import lh5
+import pipeline
+import psgio
+import rawio
+import ymvtx
+
+MANIFEST_NAME = '.batch-manifest.json'
+# The converter sources are part of every manifest entry, so editing a tool re-converts everything it touched
+TOOL_MODULES = (pipeline, psgio, aydump, rawio, dump2chip, chip2psg, ymvtx, lh5)
+
+def hash_file(filename):
+    """sha256 of the file content, read in blocks."""
+    hash_obj = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            hash_obj.update(block)
+    return hash_obj.hexdigest()
+
+def tool_hash():
+    hash_obj = hashlib.sha256()
+    for module in TOOL_MODULES:
+        with open(module.__file__, 'rb') as f:
+            hash_obj.update(f.read())
+    return hash_obj.hexdigest()
+
+def find_inputs(input_folder, extensions):
+    inputs = []
+    for root, dirs, files in os.walk(input_folder):
+        dirs.sort()
+        for file in sorted(files):
+            if os.path.splitext(file)[1].lower() in extensions:
+                inputs.append(os.path.relpath(os.path.join(root, file), input_folder))
+    return inputs
+
+def is_output(name, to, extensions):
+    # name.<input extension>.<to> is what an earlier run made of name.<input extension>
+    base, extension = os.path.splitext(name)
+    return extension.lower() == '.' + to and os.path.splitext(base)[1].lower() in extensions
+
+def load_manifest(filename):
+    if not os.path.exists(filename):
+        return {}
+    with open(filename) as f:
+        return json.load(f)
+
+def save_manifest(filename, manifest):
+    # Written to a temporary file first, so an interrupted run never leaves a truncated manifest
+    with open(filename + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(filename + '.tmp', filename)
+
+def convert_file(input_filename, output_filename, params, entry):
+    """Pool worker: converts one file unless entry shows the output is up to date. Returns the new entry, or None if skipped."""
+    content_hash = hash_file(input_filename)
+    new_entry = {'hash': content_hash, 'output': output_filename, 'params': params}
+    if entry == new_entry and os.path.exists(output_filename):
+        return None
+    os.makedirs(os.path.dirname(output_filename) or '.', exist_ok=True)
+    pipeline.run(input_filename, output_filename, params['stages'])
+    return new_entry
+
+def run_batch(input_folder, output_folder=None, to='jsonl', stages=(), extensions=('.psg',), jobs=None, manifest_filename=None, force=False):
+    """Converts every matching file under input_folder in a process pool. Returns (converted, skipped, failed) counts."""
+    output_folder = output_folder or input_folder
+    manifest_filename = manifest_filename or os.path.join(output_folder, MANIFEST_NAME)
+    manifest = load_manifest(manifest_filename)
+    params = {'to': to, 'stages': list(stages), 'tools': tool_hash()}
+    converted = skipped = failed = 0
+    # With outputs next to the inputs, earlier outputs must not be taken for new inputs
+    outputs = {os.path.normpath(entry['output']) for entry in manifest.values()}
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = {}
+        for name in find_inputs(input_folder, extensions):
+            input_filename = os.path.join(input_folder, name)
+            if is_output(name, to, extensions) or os.path.normpath(input_filename) in outputs:
+                continue
+            # Keyed by output, so converting the same input to another format keeps both entries
+            key = name + '.' + to
+            output_filename = os.path.join(output_folder, key)
+            futures[executor.submit(convert_file, input_filename, output_filename, params, None if force else manifest.get(key))] = key
+        try:
+            for future in as_completed(futures):
+                key = futures[future]
+                try:
+                    entry = future.result()
+                except Exception as e:
+                    print(f"{key}: {e}")
+                    manifest.pop(key, None)
+                    failed += 1
+                    continue
+                if entry is None:
+                    skipped += 1
+                else:
+                    manifest[key] = entry
+                    converted += 1
+        finally:
+            save_manifest(manifest_filename, manifest)
+    return converted, skipped, failed
+
+def main(args):
+    extensions = tuple('.' + extension.lstrip('.').lower() for extension in args.extensions)
+    converted, skipped, failed = run_batch(args.input_folder, args.output_folder, args.to, args.stage or (), extensions, args.jobs, args.manifest, args.force)
+    print(f"{converted} converted, {skipped} up to date, {failed} failed")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Convert every PSG/RAW/dump/YM/VTX file under a folder in parallel, skipping files that are already up to date.')
+    parser.add_argument('input_folder', help='Folder to scan recursively')
+    parser.add_argument('--output-folder', help='Mirror the tree here instead of writing next to the inputs')
+    parser.add_argument('--to', default='jsonl', choices=[extension[1:] for extension in pipeline.WRITERS], help='Output format; output goes to <input>.<format> (default: jsonl)')
+    parser.add_argument('--stage', action='append', choices=list(pipeline.STAGES), help='Pipeline stage to run the frames through, in order; repeatable')
+    parser.add_argument('--extensions', nargs='+', default=['psg'], help='Input file extensions to pick up (default: psg)')
+    parser.add_argument('--jobs', type=int, help='Worker processes (default: one per CPU)')
+    parser.add_argument('--manifest', help=f'Manifest of input hashes and parameters (default: <output folder>/{MANIFEST_NAME})')
+    parser.add_argument('--force', action='store_true', help='Ignore the manifest and convert everything')
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,86 @@
+import argparse
+import json
+from itertools import islice
+import numpy as np
+from dump2chip import CHANNEL_NAMES, MIXER_BITS
+from psgio import PSG_REGS, carry_forward, write_psg_chunks
+
+CHUNK_FRAMES = 65536  # JSONL lines read at a time
+
+def build_mask_bits():
+    # R7 bits set by each Am/Bm/Cm string, the inverse of dump2chip.generate_mask()
+    tables = []
+    for tone_bit, noise_bit, envelope_bit in MIXER_BITS:
+        table = {}
+        for n in '_n':
+            for e in '_e':
+                for t in '_t':
+                    table[n + e + t] = (noise_bit if n == 'n' else 0) | (envelope_bit if e == 'e' else 0) | (tone_bit if t == 't' else 0)
+        tables.append(table)
+    return tables
+
+MASK_BITS = build_mask_bits()
+
+def put_key(frames, key, regs, values, written, bits=0xffff):
+    # Periods go back into a fine and a coarse register; bits keeps a value to the bits its key covers
+    key_values = np.array([frame.get(key, -1) for frame in frames], dtype=np.int64)
+    present = key_values >= 0
+    key_values &= bits
+    for i, reg in enumerate(regs):
+        values[present, reg] = key_values[present] >> (8 * i) & 0xff
+        written[:, reg] |= present
+
+def frames_to_registers(frames, first_line=1):
+    """(frame_values, written) for a list of dump2chip frame dicts; a register is written when a key covering it is present.
+
+    first_line is the JSONL line number of frames[0], for error messages.
+    """
+    values = np.zeros((len(frames), PSG_REGS), dtype=np.int64)
+    written = np.zeros((len(frames), PSG_REGS), dtype=bool)
+    for ch, name in enumerate(CHANNEL_NAMES):
+        put_key(frames, name + 't', (2 * ch, 2 * ch + 1), values, written)
+        # As dump2chip reads them: volumes without the envelope mode bit, 5-bit noise periods
+        put_key(frames, name + 'v', (8 + ch,), values, written, 0x0f)
+    put_key(frames, 'N', (6,), values, written, 0x1f)
+    put_key(frames, 'Ep', (11, 12), values, written)
+    put_key(frames, 'Es', (13,), values, written)
+
+    # R7 is the union of the three channel masks; Am's 'e' and Bm's 'n' both stand for bit 4, and so on
+    mixer = np.zeros(len(frames), dtype=np.int64)
+    mixer_written = np.zeros(len(frames), dtype=bool)
+    for ch, name in enumerate(CHANNEL_NAMES):
+        key = name + 'm'
+        for i, frame in enumerate(frames):
+            if key in frame and frame[key] not in MASK_BITS[ch]:
+                raise ValueError(f"Bad {key} mask {frame[key]!r} in line {first_line + i}")
+        mixer |= [MASK_BITS[ch][frame[key]] if key in frame else 0 for frame in frames]
+        mixer_written |= [key in frame for frame in frames]
+    values[mixer_written, 7] = mixer[mixer_written]
+    written[:, 7] = mixer_written
+    return values.astype(np.uint8), written
+
+def iter_jsonl(filename, chunk_frames=CHUNK_FRAMES):
+    """Yields (states, written) for chunk_frames JSONL frames at a time, so files of any length convert in bounded memory."""
+    state = None
+    first_line = 1
+    with open(filename, 'r') as file:
+        while True:
+            lines = list(islice(file, chunk_frames))
+            if not lines:
+                break
+            frame_values, written = frames_to_registers([json.loads(line) for line in lines], first_line)
+            states = carry_forward(frame_values, written, state)
+            state = states[-1]
+            first_line += len(lines)
+            yield states, written
+
+def main(input_filename, output_filename):
+    # Every key present in a frame is written, even when it repeats a value, so the PSG converts back to the same JSONL
+    write_psg_chunks(output_filename, iter_jsonl(input_filename), changes_only=False)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Convert dump2chip JSONL frames back to a PSG file.')
+    parser.add_argument('input_filename', nargs='?', default='sync.psg.aydump.jsonl', help='The input JSONL file (default: sync.psg.aydump.jsonl)')
+    parser.add_argument('output_filename', nargs='?', help='The output PSG file (default: input_filename.psg)')
+    args = parser.parse_args()
+    main(args.input_filename, args.output_filename or args.input_filename + '.psg')
@@ -1,21 +1,15 @@
 import argparse
 import json
+import os
+import numpy as np
+from aydump import iter_dump
 
 RAW_REGS = 16
 REG_NUM = 14
-
-def read_aydump_file(filename):
-    frames = []
-    with open(filename, 'r') as file:
-        for line in file:
-            frame = []
-            for value in line.strip().split('\t'):
-                if value == '_':
-                    frame.append(None)
-                else:
-                    frame.append(int(value))
-            frames.append(frame)
-    return frames
+CHANNEL_NAMES = 'ABC'
+MIXER_BITS = ((0x01, 0x08, 0x10), (0x02, 0x10, 0x20), (0x04, 0x20, 0x40))  # tone, noise and envelope bits per channel
+TSV_COLUMNS = ('full_tone_period_a', 'full_tone_period_b', 'full_tone_period_c', 'volumeA', 'volumeB', 'volumeC',
+               'mask_a', 'mask_b', 'mask_c', 'full_envelope_period', 'envelope_shape', 'noise_period')
 
 def generate_mask(mixer, tone_mask, noise_mask, envelope_mask):
     mask = []
@@ -33,63 +27,98 @@ def generate_mask(mixer, tone_mask, noise_mask, envelope_mask):
         mask.append('_')
     return ''.join(mask)
 
-def frame_to_dict(frame):
-    result = {}
+def build_mixer_masks():
+    # generate_mask() of every R7 value, per channel
+    return np.array([[generate_mask(mixer, *bits) for mixer in range(256)] for bits in MIXER_BITS], dtype=object)
 
-    # Tone periods
-    if frame[0] is not None or frame[1] is not None:
-        result['At'] = ((frame[1] if frame[1] is not None else 0) << 8) | (frame[0] if frame[0] is not None else 0)
-    if frame[2] is not None or frame[3] is not None:
-        result['Bt'] = ((frame[3] if frame[3] is not None else 0) << 8) | (frame[2] if frame[2] is not None else 0)
-    if frame[4] is not None or frame[5] is not None:
-        result['Ct'] = ((frame[5] if frame[5] is not None else 0) << 8) | (frame[4] if frame[4] is not None else 0)
-    
-    # Volumes
-    if frame[8] is not None:
-        result['Av'] = frame[8] & 0x0f
-    if frame[9] is not None:
-        result['Bv'] = frame[9] & 0x0f
-    if frame[10] is not None:
-        result['Cv'] = frame[10] & 0x0f
-    
-    # Noise period
-    if frame[6] is not None:
-        result['N'] = frame[6] & 0x1f
-    
-    # Envelope period and shape
-    if frame[11] is not None or frame[12] is not None:
-        result['Ep'] = ((frame[12] if frame[12] is not None else 0) << 8) | (frame[11] if frame[11] is not None else 0)
-    if frame[13] is not None:
-        result['Es'] = frame[13] & 0xff
-    
-    # Mixer control
-    if frame[7] is not None:
-        mixer = frame[7]
-        result['Am'] = generate_mask(mixer, 0x01, 0x08, 0x10)
-        result['Bm'] = generate_mask(mixer, 0x02, 0x10, 0x20)
-        result['Cm'] = generate_mask(mixer, 0x04, 0x20, 0x40)
-    
-    return result
+MIXER_MASKS = build_mixer_masks()
+# mask_x columns: tone off | noise off | envelope on
+MASK_TEXT = np.array(['|'.join(f'{bits:03b}') for bits in range(8)], dtype=object)
+
+def frame_features(states, written):
+    """{key: (values, present)} for every JSONL key, over whole columns.
 
-def convert_to_jsonl(frames, output_filename):
+    As in the per-frame format, a register that was not written in a frame counts as 0
+    there, and a key is present when any register it is built from was written.
+    """
+    values = np.where(written, states, 0).astype(np.int32)
+    features = {}
+    for ch, name in enumerate(CHANNEL_NAMES):
+        features[name + 't'] = (values[:, 2 * ch] | values[:, 2 * ch + 1] << 8, written[:, 2 * ch] | written[:, 2 * ch + 1])
+        features[name + 'v'] = (values[:, 8 + ch] & 0x0f, written[:, 8 + ch])
+        features[name + 'm'] = (MIXER_MASKS[ch][values[:, 7]], written[:, 7])
+    features['N'] = (values[:, 6] & 0x1f, written[:, 6])
+    features['Ep'] = (values[:, 11] | values[:, 12] << 8, written[:, 11] | written[:, 12])
+    features['Es'] = (values[:, 13], written[:, 13])
+    return features
+
+def column_text(values, present, template):
+    """template formatted with each value where present, '' elsewhere; only distinct values are formatted."""
+    unique, inverse = np.unique(values[present], return_inverse=True)
+    texts = np.array([template.format(json.dumps(value)) for value in unique.tolist()] + [''], dtype=object)
+    index = np.full(len(values), len(unique))
+    index[present] = inverse
+    return texts[index].tolist()
+
+def format_jsonl(states, written):
+    """The JSONL lines for a block of frames, keys sorted as json.dumps(sort_keys=True) writes them."""
+    features = frame_features(states, written)
+    columns = [column_text(values, present, f', "{key}": {{}}') for key, (values, present) in sorted(features.items())]
+    return ''.join(['{' + ''.join(parts)[2:] + '}\n' for parts in zip(*columns)])
+
+def convert_to_jsonl(chunks, output_filename):
     with open(output_filename, 'w') as file:
-        for frame in frames:
-            frame_dict = frame_to_dict(frame)
-            if not frame_dict:
-                frame_dict = {}
-            file.write(json.dumps(frame_dict, sort_keys=True) + '\n')
+        for states, written in chunks:
+            file.write(format_jsonl(states, written))
+
+def format_tsv(states, written):
+    """Rows of the column-oriented feature view, one per frame that writes anything, registers not written counting as 0."""
+    # Frames without writes, the lead-in among them, have no row in the view
+    active = written.any(axis=1)
+    values = np.where(written[active], states[active], 0).astype(np.int32)
+    numbers = [values[:, 2 * ch] | values[:, 2 * ch + 1] << 8 for ch in range(3)]
+    numbers += [values[:, 8 + ch] for ch in range(3)]
+    numbers += [values[:, 11] | values[:, 12] << 8, values[:, 13], values[:, 6]]
+    every = np.ones(len(values), dtype=bool)
+    texts = [column_text(column, every, '{}') for column in numbers]
+    texts[6:6] = [MASK_TEXT[(values[:, 7] >> ch & 1) << 2 | (values[:, 7] >> (ch + 3) & 1) << 1 | values[:, 8 + ch] >> 4 & 1].tolist() for ch in range(3)]
+    return ''.join(['\t'.join(parts) + '\n' for parts in zip(*texts)])
+
+def convert_to_tsv(chunks, output_filename):
+    with open(output_filename, 'w') as file:
+        file.write('\t'.join(TSV_COLUMNS) + '\n')
+        for states, written in chunks:
+            file.write(format_tsv(states, written))
+
+def convert(chunks, output_filename, tsv_filename=None):
+    if tsv_filename is None:
+        convert_to_jsonl(chunks, output_filename)
+        return
+    # Both views from the same pass over the dump
+    with open(output_filename, 'w') as jsonl_file, open(tsv_filename, 'w') as tsv_file:
+        tsv_file.write('\t'.join(TSV_COLUMNS) + '\n')
+        for states, written in chunks:
+            jsonl_file.write(format_jsonl(states, written))
+            tsv_file.write(format_tsv(states, written))
 
-def main(input_filename, output_filename):
-    frames = read_aydump_file(input_filename)
-    convert_to_jsonl(frames, output_filename)
+def main(input_filename, output_filename, tsv_filename=None):
+    try:
+        convert(iter_dump(input_filename), output_filename, tsv_filename)
+    except Exception:
+        # The dump is read lazily after the outputs were opened, so a bad input would leave them behind
+        for filename in (output_filename, tsv_filename):
+            if filename and os.path.exists(filename):
+                os.remove(filename)
+        raise
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Convert AY register dump to JSONL format.')
     parser.add_argument('input_filename', nargs='?', default='sync.psg.aydump', help='The input AY register dump file (default: sync.psg.aydump)')
     parser.add_argument('output_filename', nargs='?', help='The output JSONL file (default: input_filename.jsonl)')
+    parser.add_argument('--tsv', action='store_true', help='Also write the column-oriented feature view to input_filename.tsv')
     args = parser.parse_args()
     
     input_filename = args.input_filename
     output_filename = args.output_filename if args.output_filename else input_filename + '.jsonl'
     
-    main(input_filename, output_filename)
+    main(input_filename, output_filename, input_filename + '.tsv' if args.tsv else None)
@@ -0,0 +1,424 @@
+import heapq
+import struct
+
+# LHarc -lh5- family: LZ77 over a 2 ** DICBIT byte window, with the literals and match
+# lengths, the match distances and the code lengths each in their own Huffman code per block
+DICBITS = {b'-lh4-': 12, b'-lh5-': 13, b'-lh6-': 15, b'-lh7-': 16}
+STORED = b'-lh0-'
+DIRECTORY = b'-lhd-'
+THRESHOLD = 3  # shortest match
+MAXMATCH = 256  # longest match
+NC = 255 + MAXMATCH + 2 - THRESHOLD  # literals and match lengths
+CBIT = 9
+NT = 19  # code length codes: 0-2 for runs of zero lengths, 3-18 for lengths 1-16
+TBIT = 5
+MAX_CODE_BITS = 16
+BLOCK_SIZE = 0xffff  # codes per block
+MATCH_CANDIDATES = 16  # earlier positions remembered per 3-byte string when compressing
+
+def build_crc_table():
+    # CRC-16/ARC, the checksum in LHA headers
+    table = []
+    for byte in range(256):
+        crc = byte
+        for _ in range(8):
+            crc = (crc >> 1) ^ 0xa001 if crc & 1 else crc >> 1
+        table.append(crc)
+    return table
+
+CRC_TABLE = build_crc_table()
+
+def crc16(data):
+    crc = 0
+    for byte in data:
+        crc = (crc >> 8) ^ CRC_TABLE[(crc ^ byte) & 0xff]
+    return crc
+
+def position_bits(dicbit):
+    # Distance codes are the bit length of the distance; -lh4- shares the -lh5- table
+    return max(dicbit, 13) + 1, 4 if dicbit <= 13 else 5
+
+class BitReader:
+    def __init__(self, data):
+        self.data = data
+        self.pos = 0
+        self.buffer = 0
+        self.count = 0
+
+    def peek(self, bits):
+        while self.count < bits:
+            # Reads past the end see zero bits, like the reference decoder
+            self.buffer = (self.buffer << 8) | (self.data[self.pos] if self.pos < len(self.data) else 0)
+            self.pos += 1
+            self.count += 8
+        return (self.buffer >> (self.count - bits)) & ((1 << bits) - 1)
+
+    def skip(self, bits):
+        self.count -= bits
+        self.buffer &= (1 << self.count) - 1
+
+    def read(self, bits):
+        value = self.peek(bits)
+        self.skip(bits)
+        return value
+
+class BitWriter:
+    def __init__(self):
+        self.out = bytearray()
+        self.buffer = 0
+        self.count = 0
+
+    def write(self, value, bits):
+        self.buffer = (self.buffer << bits) | value
+        self.count += bits
+        while self.count >= 8:
+            self.count -= 8
+            self.out.append((self.buffer >> self.count) & 0xff)
+        self.buffer &= (1 << self.count) - 1
+
+    def getvalue(self):
+        if self.count:
+            return bytes(self.out) + bytes([(self.buffer << (8 - self.count)) & 0xff])
+        return bytes(self.out)
+
+def canonical_codes(lengths):
+    """(symbol, code, length) for a canonical Huffman code: shorter codes first, then by symbol."""
+    codes = []
+    code = 0
+    for length in range(1, max(lengths, default=0) + 1):
+        for symbol, symbol_length in enumerate(lengths):
+            if symbol_length == length:
+                codes.append((symbol, code, length))
+                code += 1
+        code <<= 1
+    return codes
+
+def make_table(lengths):
+    """(bits, table): table[next bits bits of input] is the (symbol, length) that starts there."""
+    bits = max(lengths)
+    table = [None] * (1 << bits)
+    for symbol, code, length in canonical_codes(lengths):
+        span = 1 << (bits - length)
+        if (code + 1) * span > len(table):
+            raise ValueError("Bad Huffman code lengths")
+        table[code * span:(code + 1) * span] = [(symbol, length)] * span
+    return bits, table
+
+def decode_symbol(reader, huffman):
+    bits, table = huffman
+    entry = table[reader.peek(bits)] if bits else table[0]
+    if entry is None:
+        raise ValueError("Bad Huffman code")
+    reader.skip(entry[1])
+    return entry[0]
+
+def read_pt_len(reader, n_symbols, nbit, special):
+    # Lengths below 7 take 3 bits, longer ones are 7 followed by a unary count;
+    # after the special-th length a 2-bit count of zero lengths follows
+    n = reader.read(nbit)
+    if n == 0:
+        return 0, [(reader.read(nbit), 0)]
+    if n > n_symbols:
+        raise ValueError("Bad code length table")
+    lengths = [0] * n_symbols
+    i = 0
+    while i < n:
+        length = reader.read(3)
+        if length == 7:
+            while reader.read(1):
+                length += 1
+        if length > MAX_CODE_BITS:
+            raise ValueError("Bad code length table")
+        lengths[i] = length
+        i += 1
+        if i == special:
+            i += reader.read(2)
+    return make_table(lengths)
+
+def read_c_len(reader, t_huffman):
+    n = reader.read(CBIT)
+    if n == 0:
+        return 0, [(reader.read(CBIT), 0)]
+    if n > NC:
+        raise ValueError("Bad code length table")
+    lengths = [0] * NC
+    i = 0
+    while i < n:
+        code = decode_symbol(reader, t_huffman)
+        if code == 0:
+            i += 1
+        elif code == 1:
+            i += reader.read(4) + 3
+        elif code == 2:
+            i += reader.read(CBIT) + 20
+        else:
+            lengths[i] = code - 2
+            i += 1
+    return make_table(lengths[:NC])
+
+def decompress(data, size, dicbit=13):
+    """Decodes an -lh5- style stream (-lh4- to -lh7- by dicbit) into size bytes."""
+    n_positions, pbit = position_bits(dicbit)
+    reader = BitReader(data)
+    out = bytearray()
+    remaining = 0
+    while len(out) < size:
+        if remaining == 0:
+            remaining = reader.read(16)
+            t_huffman = read_pt_len(reader, NT, TBIT, 3)
+            c_huffman = read_c_len(reader, t_huffman)
+            p_huffman = read_pt_len(reader, n_positions, pbit, -1)
+        remaining -= 1
+        code = decode_symbol(reader, c_huffman)
+        if code < 256:
+            out.append(code)
+            continue
+        length = code - 256 + THRESHOLD
+        bits = decode_symbol(reader, p_huffman)
+        distance = (1 << (bits - 1)) + reader.read(bits - 1) if bits else 0
+        start = len(out) - distance - 1
+        if start < 0:
+            raise ValueError("Match before the start of the data")
+        if distance + 1 >= length:
+            out += out[start:start + length]
+        else:
+            # The copy overlaps what it writes
+            for i in range(start, start + length):
+                out.append(out[i])
+    return bytes(out[:size])
+
+def match_length(data, earlier, pos, limit):
+    length = 0
+    while length + 16 <= limit and data[earlier + length:earlier + length + 16] == data[pos + length:pos + length + 16]:
+        length += 16
+    while length < limit and data[earlier + length] == data[pos + length]:
+        length += 1
+    return length
+
+def find_codes(data, dicbit):
+    """Greedy LZ77 parse: a list of (code, distance), distance -1 for literals."""
+    window = 1 << dicbit
+    heads = {}
+    codes = []
+    pos = 0
+    while pos < len(data):
+        best_length = best_distance = 0
+        limit = min(MAXMATCH, len(data) - pos)
+        for earlier in reversed(heads.get(data[pos:pos + THRESHOLD], ())):
+            if pos - earlier > window:
+                break
+            length = match_length(data, earlier, pos, limit)
+            if length > best_length:
+                best_length, best_distance = length, pos - earlier - 1
+                if length == limit:
+                    break
+        step = best_length if best_length >= THRESHOLD else 1
+        if step > 1:
+            codes.append((256 + best_length - THRESHOLD, best_distance))
+        else:
+            codes.append((data[pos], -1))
+        for i in range(pos, min(pos + step, len(data) - THRESHOLD + 1)):
+            candidates = heads.setdefault(data[i:i + THRESHOLD], [])
+            candidates.append(i)
+            if len(candidates) > MATCH_CANDIDATES:
+                del candidates[0]
+        pos += step
+    return codes
+
+def code_lengths(counts, max_bits=MAX_CODE_BITS):
+    """Huffman code lengths for the symbol counts, halving the counts until no code is longer than max_bits."""
+    while True:
+        lengths = [0] * len(counts)
+        heap = [(count, symbol, [symbol]) for symbol, count in enumerate(counts) if count]
+        if len(heap) < 2:
+            return lengths
+        heapq.heapify(heap)
+        while len(heap) > 1:
+            count_a, order, symbols_a = heapq.heappop(heap)
+            count_b, _, symbols_b = heapq.heappop(heap)
+            for symbol in symbols_a + symbols_b:
+                lengths[symbol] += 1
+            heapq.heappush(heap, (count_a + count_b, order, symbols_a + symbols_b))
+        if max(lengths) <= max_bits:
+            return lengths
+        counts = [(count + 1) // 2 for count in counts]
+
+def write_single(writer, symbols, nbit):
+    # A table with one symbol or none is sent as a zero count and the symbol, and costs no bits per code
+    writer.write(0, nbit)
+    writer.write(symbols[0] if symbols else 0, nbit)
+
+def write_pt_len(writer, lengths, nbit, special):
+    n = max(i + 1 for i, length in enumerate(lengths) if length)
+    writer.write(n, nbit)
+    i = 0
+    while i < n:
+        length = lengths[i]
+        if length < 7:
+            writer.write(length, 3)
+        else:
+            writer.write(7, 3)
+            writer.write((1 << (length - 6)) - 2, length - 6)
+        i += 1
+        if i == special:
+            zeros = 0
+            while zeros < 3 and i + zeros < n and lengths[i + zeros] == 0:
+                zeros += 1
+            writer.write(zeros, 2)
+            i += zeros
+
+def c_len_codes(lengths):
+    """The c code lengths as (t code, extra value, extra bits), runs of zeros folded."""
+    n = max(i + 1 for i, length in enumerate(lengths) if length)
+    codes = []
+    i = 0
+    while i < n:
+        if lengths[i]:
+            codes.append((lengths[i] + 2, 0, 0))
+            i += 1
+            continue
+        run = 1
+        while i + run < n and lengths[i + run] == 0:
+            run += 1
+        i += run
+        while run:
+            if run <= 2:
+                codes.append((0, 0, 0))
+                run -= 1
+            elif run < 20:
+                take = min(run, 18)
+                codes.append((1, take - 3, 4))
+                run -= take
+            else:
+                take = min(run, 20 + (1 << CBIT) - 1)
+                codes.append((2, take - 20, CBIT))
+                run -= take
+    return n, codes
+
+def symbol_codes(lengths):
+    codes = {}
+    for symbol, code, length in canonical_codes(lengths):
+        codes[symbol] = (code, length)
+    return codes
+
+def write_block(writer, block, n_positions, pbit):
+    c_counts = [0] * NC
+    p_counts = [0] * n_positions
+    for code, distance in block:
+        c_counts[code] += 1
+        if distance >= 0:
+            p_counts[distance.bit_length()] += 1
+    writer.write(len(block), 16)
+
+    c_symbols = [symbol for symbol, count in enumerate(c_counts) if count]
+    if len(c_symbols) < 2:
+        write_single(writer, [], TBIT)
+        write_single(writer, c_symbols, CBIT)
+        c_codes = {c_symbols[0]: (0, 0)}
+    else:
+        c_lengths = code_lengths(c_counts)
+        n, len_codes = c_len_codes(c_lengths)
+        t_counts = [0] * NT
+        for code, _, _ in len_codes:
+            t_counts[code] += 1
+        t_symbols = [symbol for symbol, count in enumerate(t_counts) if count]
+        if len(t_symbols) < 2:
+            write_single(writer, t_symbols, TBIT)
+            t_codes = {t_symbols[0]: (0, 0)}
+        else:
+            t_lengths = code_lengths(t_counts)
+            write_pt_len(writer, t_lengths, TBIT, 3)
+            t_codes = symbol_codes(t_lengths)
+        writer.write(n, CBIT)
+        for code, extra, extra_bits in len_codes:
+            writer.write(*t_codes[code])
+            writer.write(extra, extra_bits)
+        c_codes = symbol_codes(c_lengths)
+
+    p_symbols = [symbol for symbol, count in enumerate(p_counts) if count]
+    if len(p_symbols) < 2:
+        write_single(writer, p_symbols, pbit)
+        p_codes = {symbol: (0, 0) for symbol in p_symbols}
+    else:
+        p_lengths = code_lengths(p_counts)
+        write_pt_len(writer, p_lengths, pbit, -1)
+        p_codes = symbol_codes(p_lengths)
+
+    for code, distance in block:
+        writer.write(*c_codes[code])
+        if distance >= 0:
+            bits = distance.bit_length()
+            writer.write(*p_codes[bits])
+            if bits > 1:
+                writer.write(distance - (1 << (bits - 1)), bits - 1)
+
+def compress(data, dicbit=13):
+    """Encodes data as an -lh5- style stream that decompress(stream, len(data), dicbit) reads back."""
+    n_positions, pbit = position_bits(dicbit)
+    codes = find_codes(bytes(data), dicbit)
+    writer = BitWriter()
+    for i in range(0, len(codes), BLOCK_SIZE):
+        write_block(writer, codes[i:i + BLOCK_SIZE], n_positions, pbit)
+    return writer.getvalue()
+
+def is_lha(data):
+    return len(data) > 21 and bytes(data[2:7]) in (*DICBITS, STORED, DIRECTORY)
+
+def read_lha(data):
+    """[(name, content)] for the members of an LHA archive with level 0, 1 or 2 headers."""
+    members = []
+    pos = 0
+    while pos < len(data) and data[pos] != 0:
+        level = data[pos + 20]
+        method = bytes(data[pos + 2:pos + 7])
+        packed_size, size = struct.unpack_from('<II', data, pos + 7)
+        if level == 2:
+            header_size, = struct.unpack_from('<H', data, pos)
+            name = b''
+            crc, = struct.unpack_from('<H', data, pos + 21)
+            ext = pos + 24
+            next_size, = struct.unpack_from('<H', data, ext)
+            ext += 2
+            while next_size:
+                if data[ext] == 1:
+                    name = bytes(data[ext + 1:ext + next_size - 2])
+                ext += next_size
+                next_size, = struct.unpack_from('<H', data, ext - 2)
+            start = pos + header_size
+        elif level in (0, 1):
+            header_size = data[pos] + 2
+            name = bytes(data[pos + 22:pos + 22 + data[pos + 21]])
+            crc, = struct.unpack_from('<H', data, pos + 22 + len(name))
+            start = pos + header_size
+            if level == 1:
+                # Extended headers come after the base header and count towards packed_size
+                next_size, = struct.unpack_from('<H', data, start - 2)
+                while next_size:
+                    if data[start] == 1:
+                        name = bytes(data[start + 1:start + next_size - 2])
+                    start += next_size
+                    packed_size -= next_size
+                    next_size, = struct.unpack_from('<H', data, start - 2)
+        else:
+            raise ValueError(f"Unsupported LHA header level {level}")
+        packed = data[start:start + packed_size]
+        pos = start + packed_size
+        if method == DIRECTORY:
+            continue
+        if method == STORED:
+            content = bytes(packed)
+        elif method in DICBITS:
+            content = decompress(packed, size, DICBITS[method])
+        else:
+            raise ValueError(f"Unsupported LHA method {method.decode('latin-1')}")
+        if crc16(content) != crc:
+            raise ValueError(f"CRC error in {name.decode('latin-1')}")
+        members.append((name.decode('latin-1'), content))
+    return members
+
+def write_lha(name, content, method=b'-lh5-'):
+    """A one-member LHA archive with a level 0 header, the layout YM files are usually packed in."""
+    packed = compress(content, DICBITS[method]) if method in DICBITS else bytes(content)
+    name = name.encode('latin-1')
+    header = method + struct.pack('<IIIBBB', len(packed), len(content), 0, 0x20, 0, len(name)) + name + struct.pack('<H', crc16(content))
+    return bytes([len(header), sum(header) & 0xff]) + header + packed + b'\x00'
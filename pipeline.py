@@ -0,0 +1,122 @@
+import argparse
+import os
+import numpy as np
+from aydump import BINARY_SUFFIX, TEXT_SUFFIX, concatenate_chunks, iter_dump, optimize_chunks, write_dump, write_text_chunks
+from chip2psg import iter_jsonl
+from dump2chip import convert_to_jsonl, convert_to_tsv
+from psgio import PSG_REGS, drop_lead_in, load_psg, raw_frames, unpack_raw, write_psg_chunks
+from rawio import open_raw
+from ymvtx import load_vtx, load_ym, save_vtx, save_ym
+
+# Every stage passes along (states, written) blocks of frames, numbered like
+# decode_psg numbers them: frame 0 is the empty lead-in before the first 0xff
+CHUNK_FRAMES = 65536
+
+def split_chunks(states, written, chunk_frames=CHUNK_FRAMES):
+    for i in range(0, len(states), chunk_frames):
+        yield states[i:i + chunk_frames], written[i:i + chunk_frames]
+
+def read_psg_chunks(filename, chunk_frames=CHUNK_FRAMES):
+    return split_chunks(*load_psg(filename), chunk_frames)
+
+def read_ym_chunks(filename, chunk_frames=CHUNK_FRAMES):
+    states, written, info = load_ym(filename)
+    return split_chunks(states, written, chunk_frames)
+
+def read_vtx_chunks(filename, chunk_frames=CHUNK_FRAMES):
+    states, written, info = load_vtx(filename)
+    return split_chunks(states, written, chunk_frames)
+
+def read_raw_chunks(filename, chunk_frames=CHUNK_FRAMES):
+    raw = open_raw(filename)
+    yield np.zeros((1, PSG_REGS), dtype=np.uint8), np.zeros((1, PSG_REGS), dtype=bool)
+    for i in range(0, len(raw), chunk_frames):
+        # One frame of overlap, so R13 writes are told apart from the frame before
+        start = max(i - 1, 0)
+        states, written = unpack_raw(raw[start:i + chunk_frames])
+        yield states[i - start:], written[i - start:]
+
+def write_raw_chunks(filename, chunks):
+    with open(filename, 'wb') as f:
+        first = True
+        for states, written in chunks:
+            if first and len(states):
+                states, written = drop_lead_in(states, written)
+                first = False
+            raw_frames(states, written).tofile(f)
+
+def write_dump_chunks(filename, chunks):
+    write_dump(filename, *concatenate_chunks(chunks))
+
+READERS = {
+    '.psg': read_psg_chunks,
+    '.raw': read_raw_chunks,
+    TEXT_SUFFIX: iter_dump,
+    BINARY_SUFFIX: iter_dump,
+    '.jsonl': iter_jsonl,
+    '.ym': read_ym_chunks,
+    '.vtx': read_vtx_chunks,
+}
+WRITERS = {
+    '.psg': write_psg_chunks,
+    '.raw': write_raw_chunks,
+    TEXT_SUFFIX: write_text_chunks,
+    BINARY_SUFFIX: write_dump_chunks,
+    '.jsonl': lambda filename, chunks: convert_to_jsonl(chunks, filename),
+    '.tsv': lambda filename, chunks: convert_to_tsv(chunks, filename),
+    '.ym': lambda filename, chunks: save_ym(filename, *concatenate_chunks(chunks)),
+    '.vtx': lambda filename, chunks: save_vtx(filename, *concatenate_chunks(chunks)),
+}
+KEEP_ALL_WRITES = {'.jsonl'}  # inputs whose repeated writes are kept, like chip2psg does
+STAGES = {
+    'optimize': optimize_chunks,
+}
+
+def file_type(filename, types):
+    extension = os.path.splitext(filename)[1].lower()
+    if extension not in types:
+        raise ValueError(f"{filename}: unsupported file type, expected one of {', '.join(types)}")
+    return extension
+
+def read_chunks(filename, chunk_frames=CHUNK_FRAMES):
+    return READERS[file_type(filename, READERS)](filename, chunk_frames)
+
+def write_chunks(filename, chunks, changes_only=True):
+    extension = file_type(filename, WRITERS)
+    if extension == '.psg':
+        write_psg_chunks(filename, chunks, changes_only)
+    else:
+        WRITERS[extension](filename, chunks)
+
+def run(input_filename, output_filename, stages=(), chunk_frames=CHUNK_FRAMES):
+    """Converts input_filename to output_filename through the named stages, without intermediate files."""
+    chunks = read_chunks(input_filename, chunk_frames)
+    for stage in stages:
+        chunks = STAGES[stage](chunks)
+    # Every key present in a JSONL frame is written, even when it repeats a value, so the PSG converts back to the same JSONL
+    changes_only = file_type(input_filename, READERS) not in KEEP_ALL_WRITES
+    try:
+        write_chunks(output_filename, chunks, changes_only)
+    except Exception:
+        # Stages run lazily inside the writer, so a bad input fails after the output was opened
+        if os.path.exists(output_filename):
+            os.remove(output_filename)
+        raise
+
+def main(args):
+    if args.output and len(args.input_filenames) > 1:
+        raise SystemExit("--output takes a single input file")
+    for input_filename in args.input_filenames:
+        output_filename = args.output or input_filename + '.' + args.to
+        run(input_filename, output_filename, args.stage or (), args.chunk_frames)
+        print(f"{input_filename} -> {output_filename}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Convert between PSG, RAW, register dumps and JSONL in one pass, without writing intermediate files.')
+    parser.add_argument('input_filenames', nargs='+', help='Input files: .psg, .raw, .aydump, .aydb, dump2chip .jsonl, .ym or .vtx')
+    parser.add_argument('--to', default='jsonl', choices=[extension[1:] for extension in WRITERS], help='Output format; output goes to input_filename.<format> (default: jsonl)')
+    parser.add_argument('--output', help='Output filename for a single input, its extension picks the format')
+    parser.add_argument('--stage', action='append', choices=list(STAGES), help='Stage to run the frames through on the way, in order; repeatable')
+    parser.add_argument('--chunk-frames', type=int, default=CHUNK_FRAMES, help=f'Frames passed between stages at a time (default: {CHUNK_FRAMES})')
+    args = parser.parse_args()
+    main(args)
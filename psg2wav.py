@@ -0,0 +1,247 @@
+import argparse
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from ayumi import Ayumi, CHUNK_SIZE, open_wav, to_pcm16, write_wav
+from psgio import from_frame_lists, load_psg, raw_frames
+from rawio import open_raw
+
+FRAME_RATE = 50
+REG_NUM = 14
+RAW_REGS = 16
+PANNING = (1 / 3, 1 / 3)  # each of the three channels gets a third of the output range
+STEM_NAMES = ('A', 'B', 'C')
+SNAPSHOT_SUFFIX = '.snap.npz'
+MAX_SEGMENT_FRAMES = 500  # default parallel segment length, 10 s at 50 Hz
+
+def frames_from_raw(raw):
+    """Turns psg2raw output (16 bytes per frame, R13 | 0x80 when not written) into an (n, 16) uint8 array."""
+    return np.frombuffer(bytes(raw), dtype=np.uint8).reshape(-1, RAW_REGS)
+
+def frames_from_dump(frames):
+    """Turns psg2dump.parse_psg_data frames (None = not written) into full register states in the RAW layout."""
+    return raw_frames(*from_frame_lists(frames))
+
+def apply_registers(ayumi, regs):
+    regs = [int(r) for r in regs]
+    for ch in range(3):
+        ayumi.set_tone(ch, regs[2 * ch] | (regs[2 * ch + 1] & 0x0f) << 8)
+        ayumi.set_mixer(ch, regs[7] >> ch, regs[7] >> (ch + 3), regs[8 + ch] >> 4)
+        ayumi.set_volume(ch, regs[8 + ch])
+    ayumi.set_noise(regs[6] & 0x1f)
+    envelope_period = regs[11] | regs[12] << 8
+    if regs[13] & 0x80:
+        ayumi.set_envelope_period(envelope_period)
+    else:
+        ayumi.set_envelope(regs[13] & 0x0f, envelope_period)
+
+def frame_runs(frames, sample_rate, frame_rate=FRAME_RATE, first_frame=0, split_every=0):
+    """Yields (start, end, num_samples) for every run of frames that can be rendered as one block.
+
+    Sample counts are taken from the absolute frame numbers first_frame + i, so a window
+    lines up sample for sample with a render from frame 0. With split_every, runs are also
+    cut at every frame number divisible by it."""
+    n = len(frames)
+    if n == 0:
+        return
+    # Consecutive frames that change nothing and do not retrigger the envelope are rendered as one block
+    changed = np.any(frames[1:] != frames[:-1], axis=1) | ((frames[1:, 13] & 0x80) == 0)
+    if split_every:
+        changed |= (first_frame + np.arange(1, n)) % split_every == 0
+    starts = np.concatenate(([0], np.flatnonzero(changed) + 1))
+    ends = np.append(starts[1:], n)
+    boundaries = np.arange(first_frame, first_frame + n + 1, dtype=np.int64) * sample_rate // frame_rate
+    for start, end in zip(starts, ends):
+        yield int(start), int(end), int(boundaries[end] - boundaries[start])
+
+def render_frames(ayumi, frames, frame_rate=FRAME_RATE, chunk_size=CHUNK_SIZE, stems=False, first_frame=0, snapshot_every=0, snapshots=None):
+    """Yields blocks of at most chunk_size samples, one or more per run of identical frames; frames is an (n, 14) or (n, 16) RAW-layout array.
+
+    With stems=True every block is a (mix, stems) pair from Ayumi.render_stems().
+    With snapshot_every=K the chip state at the start of every K-th frame is stored in
+    the snapshots dict, keyed by frame number."""
+    frames = np.asarray(frames, dtype=np.uint8)[:, :REG_NUM]
+    for start, end, num_samples in frame_runs(frames, ayumi.sample_rate, frame_rate, first_frame, snapshot_every):
+        if snapshot_every and (first_frame + start) % snapshot_every == 0:
+            snapshots[first_frame + start] = ayumi.get_state()
+        apply_registers(ayumi, frames[start])
+        for offset in range(0, num_samples, chunk_size):
+            if stems:
+                yield ayumi.render_stems(min(chunk_size, num_samples - offset))
+            else:
+                yield ayumi.render_block(min(chunk_size, num_samples - offset))
+
+def seek(ayumi, frames, frame, snapshots, frame_rate=FRAME_RATE):
+    """Puts a freshly created ayumi into the state a full render has at the start of frame.
+
+    Starts from the nearest snapshot at or before frame and advances through the
+    remaining frames without rendering them."""
+    frames = np.asarray(frames, dtype=np.uint8)[:, :REG_NUM]
+    start = max((f for f in snapshots if f <= frame), default=0)
+    if start in snapshots:
+        ayumi.set_state(snapshots[start])
+    for run_start, run_end, num_samples in frame_runs(frames[start:frame], ayumi.sample_rate, frame_rate, start):
+        apply_registers(ayumi, frames[start + run_start])
+        ayumi.advance(num_samples)
+
+def render_window(ayumi, frames, start_frame, end_frame, snapshots=None, frame_rate=FRAME_RATE, chunk_size=CHUNK_SIZE, stems=False):
+    """Yields the blocks of frames start_frame..end_frame, sample-identical to the same span of a full render."""
+    seek(ayumi, frames, start_frame, snapshots or {}, frame_rate)
+    return render_frames(ayumi, frames[start_frame:end_frame], frame_rate, chunk_size, stems, first_frame=start_frame)
+
+def capture_snapshots(ayumi, frames, every, frame_rate=FRAME_RATE):
+    """Register-only pass over frames: returns the {frame: state} snapshot at every every-th frame.
+
+    Nothing is rendered except the few core samples the decimation filter keeps, so
+    this is much cheaper than a render."""
+    frames = np.asarray(frames, dtype=np.uint8)[:, :REG_NUM]
+    snapshots = {}
+    for start, end, num_samples in frame_runs(frames, ayumi.sample_rate, frame_rate, 0, every):
+        if start % every == 0:
+            snapshots[start] = ayumi.get_state()
+        apply_registers(ayumi, frames[start])
+        ayumi.advance(num_samples)
+    return snapshots
+
+def ayumi_settings(ayumi):
+    return {
+        'dac_type': ayumi.dac_type,
+        'panning': ayumi.panning,
+        'sample_rate': ayumi.sample_rate,
+        'clock_frequency': ayumi.clock_frequency,
+        'oversample': ayumi.oversample,
+    }
+
+def render_segment(settings, frames, first_frame, state, frame_rate, stems):
+    # Runs in a worker process: rebuild the chip from its snapshot and render one segment
+    ayumi = Ayumi(**settings)
+    ayumi.set_state(state)
+    blocks = list(render_frames(ayumi, frames, frame_rate, len(frames) * ayumi.sample_rate, stems, first_frame))
+    if stems:
+        return np.concatenate([mix for mix, _ in blocks]), np.concatenate([stem for _, stem in blocks])
+    return np.concatenate(blocks)
+
+def render_parallel(ayumi, frames, frame_rate=FRAME_RATE, jobs=None, segment_frames=None, stems=False, snapshots=None):
+    """Yields the same samples as render_frames(), rendered as segments across a process pool.
+
+    A register-only pre-pass captures the chip state at each segment boundary, so every
+    segment starts exactly where the serial render would be and the stitched output is
+    sample-identical. Segments come back in order, one block each. If snapshots is given,
+    the boundary states are stored in it, as render_frames() does with snapshot_every."""
+    frames = np.asarray(frames, dtype=np.uint8)[:, :REG_NUM]
+    jobs = jobs or os.cpu_count()
+    if not segment_frames:
+        # A few segments per worker keeps the pool busy when some segments render slower;
+        # the cap keeps the segments in flight small however long the track is
+        segment_frames = max(1, min(-(-len(frames) // (jobs * 4)), MAX_SEGMENT_FRAMES))
+    settings = ayumi_settings(ayumi)
+    boundaries = capture_snapshots(ayumi, frames, segment_frames, frame_rate)
+    if snapshots is not None:
+        snapshots.update(boundaries)
+    starts = sorted(boundaries)
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        # Only a couple of segments per worker are in flight, so memory stays bounded on long tracks
+        pending = deque()
+        for start in starts:
+            pending.append(executor.submit(render_segment, settings, frames[start:start + segment_frames], start, boundaries[start], frame_rate, stems))
+            if len(pending) >= 2 * jobs:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+def snapshot_config(ayumi, frame_rate):
+    # Snapshots only fit an Ayumi with the same settings
+    return np.array([ayumi.dac_type == 'YM', ayumi.sample_rate, ayumi.clock_frequency, ayumi.oversample, frame_rate], dtype=np.int64)
+
+def save_snapshots(filename, ayumi, snapshots, frame_rate=FRAME_RATE):
+    frames = np.array(sorted(snapshots), dtype=np.int64)
+    states = np.array([snapshots[frame] for frame in frames]).reshape(len(frames), -1)
+    with open(filename, 'wb') as file:
+        np.savez(file, config=snapshot_config(ayumi, frame_rate), frames=frames, states=states)
+
+def load_snapshots(filename, ayumi, frame_rate=FRAME_RATE):
+    """Returns the {frame: state} snapshots saved in filename, or {} if they were taken with other settings."""
+    with np.load(filename) as index:
+        if not np.array_equal(index['config'], snapshot_config(ayumi, frame_rate)):
+            return {}
+        return dict(zip(index['frames'].tolist(), index['states']))
+
+def load_psg_frames(filename):
+    return raw_frames(*load_psg(filename))
+
+def load_frames(filename):
+    """RAW layout frames for a .psg file, or a read-only memory map of a .raw file."""
+    if filename.lower().endswith('.raw'):
+        return open_raw(filename)
+    return load_psg_frames(filename)
+
+def render_psg(filename, ayumi, frame_rate=FRAME_RATE):
+    blocks = list(render_frames(ayumi, load_psg_frames(filename), frame_rate))
+    if not blocks:
+        return np.zeros((0, 2), dtype=np.float32)
+    return np.concatenate(blocks)
+
+def write_stems(basename, blocks, sample_rate):
+    """Streams (mix, stems) blocks to basename.wav and one mono basename.A/B/C.wav per channel."""
+    mix_file = open_wav(basename + '.wav', sample_rate)
+    stem_files = [open_wav(f'{basename}.{name}.wav', sample_rate, 1) for name in STEM_NAMES]
+    try:
+        for mix, stems in blocks:
+            mix_file.writeframes(to_pcm16(mix))
+            for i, stem_file in enumerate(stem_files):
+                stem_file.writeframes(to_pcm16(stems[:, i]))
+    finally:
+        for wav_file in [mix_file] + stem_files:
+            wav_file.close()
+
+def main(args):
+    oversample = args.oversample if args.oversample == 'clock' else int(args.oversample)
+    for input_filename in args.input_filenames:
+        ayumi = Ayumi(dac_type=args.dac, panning=PANNING, sample_rate=args.sample_rate, clock_frequency=args.clock, oversample=oversample)
+        frames = load_frames(input_filename)
+        snapshot_filename = input_filename + SNAPSHOT_SUFFIX
+        snapshots = {}
+        basename = input_filename
+        if args.start is not None:
+            start_frame = int(args.start * args.frame_rate)
+            if not 0 <= start_frame < len(frames):
+                print(f"{input_filename}: --start {args.start}s is outside the {len(frames) / args.frame_rate:.1f}s track, skipped")
+                continue
+            # Preview window: seek from the nearest saved snapshot instead of rendering from frame 0
+            if os.path.exists(snapshot_filename):
+                snapshots = load_snapshots(snapshot_filename, ayumi, args.frame_rate)
+            end_frame = len(frames) if args.duration is None else start_frame + int(args.duration * args.frame_rate)
+            # Previews get their own name, so they never overwrite the full render
+            basename = f"{input_filename}.{args.start:g}s" if args.duration is None else f"{input_filename}.{args.start:g}s+{args.duration:g}s"
+            blocks = render_window(ayumi, frames, start_frame, end_frame, snapshots, args.frame_rate, args.chunk_size, args.stems)
+        elif args.jobs > 1:
+            start_frame, end_frame = 0, len(frames)
+            blocks = render_parallel(ayumi, frames, args.frame_rate, args.jobs, args.snapshot_every, args.stems, snapshots)
+        else:
+            start_frame, end_frame = 0, len(frames)
+            blocks = render_frames(ayumi, frames, args.frame_rate, args.chunk_size, args.stems, snapshot_every=args.snapshot_every, snapshots=snapshots)
+        if args.stems:
+            write_stems(basename, blocks, args.sample_rate)
+        else:
+            write_wav(basename + '.wav', blocks, args.sample_rate)
+        if args.snapshot_every and args.start is None:
+            save_snapshots(snapshot_filename, ayumi, snapshots, args.frame_rate)
+        print(f"{input_filename}: {(min(end_frame, len(frames)) - start_frame) / args.frame_rate:.1f}s rendered")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Render PSG files to WAV through the Ayumi emulator.')
+    parser.add_argument('input_filenames', nargs='*', default=['sync.psg'], help='The input PSG or RAW files (default: sync.psg); output goes to input_filename.wav')
+    parser.add_argument('--dac', default='AY', choices=['AY', 'YM'], help='Chip type (default: AY)')
+    parser.add_argument('--sample-rate', type=int, default=44100, help='Output sample rate (default: 44100)')
+    parser.add_argument('--clock', type=int, default=1750000, help='Chip clock frequency in Hz (default: 1750000)')
+    parser.add_argument('--frame-rate', type=int, default=FRAME_RATE, help='Register frames per second (default: 50)')
+    parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE, help=f'Samples rendered and written per block (default: {CHUNK_SIZE})')
+    parser.add_argument('--oversample', default='1', help="Run the chip core at this multiple of the sample rate and decimate, or 'clock' for about clock / 8 (default: 1)")
+    parser.add_argument('--stems', action='store_true', help='Also write each channel to a mono input_filename.A/B/C.wav')
+    parser.add_argument('--snapshot-every', type=int, default=0, help=f'Save the chip state every N frames to input_filename{SNAPSHOT_SUFFIX} (default: off)')
+    parser.add_argument('--start', type=float, help=f'Render from this many seconds in, seeking from input_filename{SNAPSHOT_SUFFIX} if present; output goes to input_filename.<start>s.wav')
+    parser.add_argument('--duration', type=float, help='Seconds to render from --start (default: to the end); output goes to input_filename.<start>s+<duration>s.wav')
+    parser.add_argument('--jobs', type=int, default=1, help='Render segments of each file in this many processes (default: 1); segments are --snapshot-every frames long when that is set')
+    args = parser.parse_args()
+    main(args)
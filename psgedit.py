@@ -0,0 +1,136 @@
+import argparse
+from fractions import Fraction
+from functools import lru_cache
+import numpy as np
+from dump2chip import CHANNEL_NAMES
+from psgio import PSG_REGS, changed_writes, drop_lead_in, load_psg, write_psg
+from rawio import FRAME_RATE
+
+# Every edit takes and returns (states, written) frame matrices, numbered like decode_psg,
+# and works on whole arrays; save_psg() re-encodes the result
+TONE_PERIODS = 4096
+ENVELOPE_PERIODS = 65536
+# (fine, coarse, periods) for the three tone periods and the envelope period
+PERIOD_REGISTERS = ((0, 1, TONE_PERIODS), (2, 3, TONE_PERIODS), (4, 5, TONE_PERIODS))
+ENVELOPE_PERIOD_REGISTERS = (11, 12, ENVELOPE_PERIODS)
+
+def settle(states, written, previous, written_before):
+    """written, with the first frame also writing every register that differs from previous or was set before."""
+    written = written.copy()
+    if len(written):
+        written[0] |= (states[0] != previous) | written_before
+    return written
+
+def cut(states, written, start, stop=None):
+    """Frames [start, stop); the first one writes every register set before it, so the cut plays on its own."""
+    start, stop, _ = slice(start, stop).indices(len(states))
+    written_before = written[:start].any(axis=0)
+    states, written = states[start:stop], written[start:stop]
+    return states, settle(states, written, np.zeros(PSG_REGS, dtype=np.uint8), written_before)
+
+def cut_seconds(states, written, start_seconds, end_seconds=None, frame_rate=FRAME_RATE):
+    stop = None if end_seconds is None else int(end_seconds * frame_rate)
+    return cut(states, written, int(start_seconds * frame_rate), stop)
+
+def concatenate(parts):
+    """Plays the (states, written) parts one after another.
+
+    Later parts lose their lead-in, and start by writing every register that differs
+    from where the part before left the chip.
+    """
+    all_states = [np.zeros((0, PSG_REGS), dtype=np.uint8)]
+    all_written = [np.zeros((0, PSG_REGS), dtype=bool)]
+    previous = np.zeros(PSG_REGS, dtype=np.uint8)
+    for states, written in parts:
+        if len(all_states) > 1:
+            states, written = drop_lead_in(states, written)
+        if not len(states):
+            continue
+        all_states.append(states)
+        all_written.append(settle(states, written, previous, np.zeros(PSG_REGS, dtype=bool)))
+        previous = states[-1]
+    return np.concatenate(all_states), np.concatenate(all_written)
+
+def stretch(states, written, factor):
+    """Plays the frames factor times as long; factor < 1 speeds them up.
+
+    New frame j shows source frame floor(j / factor). A register counts as written when
+    any source frame the new frame stands for wrote it, so dropped frames still restart
+    the envelope.
+    """
+    factor = Fraction(factor).limit_denominator(1 << 16)
+    n_frames = len(states) * factor.numerator // factor.denominator
+    source = np.arange(n_frames, dtype=np.int64) * factor.denominator // factor.numerator
+    writes = np.zeros((len(states) + 1, PSG_REGS), dtype=np.int32)
+    np.cumsum(written, axis=0, out=writes[1:])
+    covered_from = np.concatenate(([0], source[:-1] + 1))
+    return states[source], writes[source + 1] > writes[covered_from]
+
+def resample(states, written, frame_rate, new_frame_rate=FRAME_RATE):
+    """The same music played by a player ticking new_frame_rate times a second instead of frame_rate."""
+    return stretch(states, written, Fraction(new_frame_rate) / Fraction(frame_rate))
+
+@lru_cache(maxsize=None)
+def period_table(semitones, periods=TONE_PERIODS):
+    """period -> the period semitones higher (lower when negative), kept in range; 0 stays 0."""
+    table = np.clip(np.rint(np.arange(periods) * 2.0 ** (-semitones / 12)), 1, periods - 1).astype(np.int64)
+    table[0] = 0
+    return table
+
+def transpose(states, written, semitones, envelope=False):
+    """Rewrites the tone periods through period_table(); with envelope=True the envelope period too, for buzzer basses.
+
+    Both registers of a period are written whenever either was, so a new coarse value
+    never lags its fine value.
+    """
+    states = states.copy()
+    written = written.copy()
+    for fine, coarse, periods in PERIOD_REGISTERS + ((ENVELOPE_PERIOD_REGISTERS,) if envelope else ()):
+        period = (states[:, fine] | states[:, coarse].astype(np.int64) << 8) & (periods - 1)
+        period = period_table(semitones, periods)[period]
+        states[:, fine] = period & 0xff
+        states[:, coarse] = period >> 8
+        written[:, fine] = written[:, coarse] = written[:, fine] | written[:, coarse]
+    return states, written
+
+def mute(states, written, channels):
+    """Silences the given channels ('A', 'B', 'C' or 0-2) by holding their volume at 0."""
+    states = states.copy()
+    for channel in channels:
+        states[:, 8 + (CHANNEL_NAMES.index(channel.upper()) if isinstance(channel, str) else channel)] = 0
+    return states, written
+
+def save_psg(filename, states, written):
+    # Edits can leave writes that no longer change anything
+    write_psg(filename, states, changed_writes(states, written))
+
+def main(args):
+    states, written = load_psg(args.input_filename)
+    if args.start or args.end is not None:
+        states, written = cut_seconds(states, written, args.start, args.end)
+    if args.append:
+        states, written = concatenate([(states, written)] + [load_psg(filename) for filename in args.append])
+    if args.stretch:
+        states, written = stretch(states, written, args.stretch)
+    if args.resample:
+        states, written = resample(states, written, *args.resample)
+    if args.transpose:
+        states, written = transpose(states, written, args.transpose, args.transpose_envelope)
+    if args.mute:
+        states, written = mute(states, written, args.mute)
+    save_psg(args.output_filename, states, written)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Edit a PSG file: the edits given run in the order listed here.')
+    parser.add_argument('input_filename', help='The input PSG file')
+    parser.add_argument('output_filename', help='The output PSG file')
+    parser.add_argument('--start', type=float, default=0, help='Cut from this many seconds in')
+    parser.add_argument('--end', type=float, help='Cut up to this many seconds in')
+    parser.add_argument('--append', nargs='+', metavar='PSG', help='PSG files to play after the input')
+    parser.add_argument('--stretch', type=float, help='Play this many times as long')
+    parser.add_argument('--resample', type=float, nargs=2, metavar=('FROM', 'TO'), help='Convert from a player rate to another, in frames per second')
+    parser.add_argument('--transpose', type=float, help='Semitones to transpose by, negative to go down')
+    parser.add_argument('--transpose-envelope', action='store_true', help='Transpose the envelope period as well')
+    parser.add_argument('--mute', nargs='+', choices=list(CHANNEL_NAMES), help='Channels to silence')
+    args = parser.parse_args()
+    main(args)
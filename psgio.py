@@ -0,0 +1,293 @@
+import os
+import numpy as np
+
+PSG_ID = b'PSG\x1A'
+PSG_HEADER_SIZE = 16
+PSG_REGS = 14
+RAW_REGS = 16
+
+END_OF_FRAME = 0xff
+MULTI_END_OF_FRAME = 0xfe  # followed by a byte n: n * 4 frames end here
+END_OF_MUSIC = 0xfd
+
+# Register bits the sound generator reads; R7 keeps its I/O port bits, the host machine reads those
+USED_BITS = np.array([0xff, 0x0f, 0xff, 0x0f, 0xff, 0x0f, 0x1f, 0xff, 0x1f, 0x1f, 0x1f, 0xff, 0xff, 0x0f], dtype=np.uint8)
+
+INDEX_SUFFIX = '.idx.npz'
+INDEX_EVERY = 256  # frames between index checkpoints
+
+def read_psg(filename):
+    """Returns a memoryview of the PSG command stream that follows the header."""
+    with open(filename, 'rb') as f:
+        data = f.read()
+    if data[:4] != PSG_ID:
+        raise ValueError("Not a valid PSG file")
+    return memoryview(data)[PSG_HEADER_SIZE:]
+
+def command_positions(stream):
+    """Offsets of the command bytes in stream; the rest are operands of the byte before them."""
+    # Register numbers and 0xfe take an operand, anything else is a one-byte command.
+    # A byte following a one-byte command (or operand) is always a command, and from
+    # there on commands and operands alternate until the next one-byte command.
+    takes_operand = (stream <= 0x0d) | (stream == MULTI_END_OF_FRAME)
+    starts = np.ones(len(stream), dtype=bool)
+    starts[1:] = ~takes_operand[:-1]
+    index = np.arange(len(stream), dtype=np.int64)
+    offset = np.where(starts, index, 0)
+    np.maximum.accumulate(offset, out=offset)
+    offset -= index
+    return np.flatnonzero((offset & 1) == 0)
+
+def decode_commands(stream):
+    """(positions, commands, operands, frame_ends) for the commands of a PSG command stream up to 0xfd."""
+    positions = command_positions(stream)
+    commands = stream[positions]
+    end = np.flatnonzero(commands == END_OF_MUSIC)
+    if len(end):
+        positions, commands = positions[:end[0] + 1], commands[:end[0] + 1]
+    # A command cut off before its operand is dropped
+    if len(positions) and positions[-1] + 1 == len(stream) and (commands[-1] <= 0x0d or commands[-1] == MULTI_END_OF_FRAME):
+        positions, commands = positions[:-1], commands[:-1]
+    operands = stream[np.minimum(positions + 1, len(stream) - 1)].astype(np.int64)
+    frame_ends = np.where(commands == MULTI_END_OF_FRAME, operands * 4, 0)
+    frame_ends[(commands == END_OF_FRAME) | (commands == END_OF_MUSIC)] = 1
+    return positions, commands, operands, frame_ends
+
+def frames_from_commands(commands, operands, frame_ends, initial=None):
+    frame = np.cumsum(frame_ends)
+    is_write = commands < PSG_REGS
+    n_frames = int(frame[-1]) if len(frame) else 0
+    if is_write.any() and frame[is_write][-1] == n_frames:
+        n_frames += 1
+
+    # Only the last write of a register within a frame counts
+    keys = frame[is_write] * PSG_REGS + commands[is_write]
+    keys, last = np.unique(keys[::-1], return_index=True)
+    values = operands[is_write][::-1][last]
+    written = np.zeros((n_frames, PSG_REGS), dtype=bool)
+    written.flat[keys] = True
+    frame_values = np.zeros((n_frames, PSG_REGS), dtype=np.uint8)
+    frame_values.flat[keys] = values
+    return carry_forward(frame_values, written, initial), written
+
+def decode_psg(data, initial=None):
+    """Decodes a PSG command stream into (states, written).
+
+    states is an (n_frames, 14) uint8 matrix of register values after each frame and
+    written an (n_frames, 14) bool mask of the registers set during that frame. Frame 0
+    holds whatever is written before the first end-of-frame marker, 0xfe n counts as
+    n * 4 markers, and a trailing frame without a marker is kept if it writes anything.
+    initial holds the registers before the stream starts (default: all zero).
+    """
+    positions, commands, operands, frame_ends = decode_commands(np.frombuffer(data, dtype=np.uint8))
+    return frames_from_commands(commands, operands, frame_ends, initial)
+
+def decode_psg_indexed(data, every=INDEX_EVERY):
+    """decode_psg, plus the frame index with a checkpoint at every every-th frame.
+
+    A checkpoint holds where the frame's commands start in the stream and the registers
+    before it. A frame that starts inside a 0xfe record points at the record, with skip
+    set to how many of its frames come before.
+    """
+    positions, commands, operands, frame_ends = decode_commands(np.frombuffer(data, dtype=np.uint8))
+    states, written = frames_from_commands(commands, operands, frame_ends)
+    frames = np.arange(0, len(states), every)
+    offsets = np.zeros(len(frames), dtype=np.int64)
+    skips = np.zeros(len(frames), dtype=np.int64)
+    if len(frames) > 1:
+        # Frame f > 0 starts right after the f-th frame end
+        ends = np.cumsum(frame_ends)
+        command = np.searchsorted(ends, frames[1:])
+        skip = frames[1:] - (ends[command] - frame_ends[command])
+        after = skip == frame_ends[command]
+        length = np.where(commands[command] == MULTI_END_OF_FRAME, 2, 1)
+        offsets[1:] = np.where(after, positions[command] + length, positions[command])
+        skips[1:] = np.where(after, 0, skip)
+    before = np.vstack((np.zeros((1, PSG_REGS), dtype=np.uint8), states))[frames]
+    index = {'every': every, 'n_frames': len(states), 'frames': frames, 'offsets': offsets, 'skips': skips, 'states': before}
+    return states, written, index
+
+def psg_fingerprint(filename):
+    stat = os.stat(filename)
+    return np.array([stat.st_size, stat.st_mtime_ns], dtype=np.int64)
+
+def load_psg_index(filename, every=INDEX_EVERY):
+    """The frame index of a PSG file, from its companion index file while that matches the
+    file, otherwise by decoding the file once and saving the index next to it."""
+    index_filename = filename + INDEX_SUFFIX
+    fingerprint = psg_fingerprint(filename)
+    if os.path.exists(index_filename):
+        with np.load(index_filename) as saved:
+            if np.array_equal(saved['source'], fingerprint) and int(saved['every']) == every:
+                return {key: saved[key] for key in saved.files if key != 'source'}
+    _, _, index = decode_psg_indexed(read_psg(filename), every)
+    np.savez(index_filename, source=fingerprint, **index)
+    return index
+
+def read_psg_frames(filename, start, stop, index=None):
+    """(states, written) for frames start to stop - 1 of a PSG file, as decode_psg numbers them.
+
+    Only the bytes between the checkpoints around the range are read and decoded.
+    """
+    if index is None:
+        index = load_psg_index(filename)
+    every = int(index['every'])
+    stop = min(stop, int(index['n_frames']))
+    start = min(max(start, 0), stop)
+    if start >= stop:
+        return np.zeros((0, PSG_REGS), dtype=np.uint8), np.zeros((0, PSG_REGS), dtype=bool)
+    first, last = start // every, -(-stop // every)
+    with open(filename, 'rb') as f:
+        f.seek(PSG_HEADER_SIZE + int(index['offsets'][first]))
+        if last < len(index['frames']):
+            # Up to the next checkpoint, taking in the whole 0xfe record it may sit in
+            end = int(index['offsets'][last]) + (2 if index['skips'][last] else 0)
+            data = f.read(end - int(index['offsets'][first]))
+        else:
+            data = f.read()
+    states, written = decode_psg(data, index['states'][first])
+    skip = int(index['skips'][first]) + start - int(index['frames'][first])
+    return states[skip:skip + stop - start], written[skip:skip + stop - start]
+
+def carry_forward(frame_values, written, initial=None):
+    """Fills every register that was not written in a frame with its value from the last frame that wrote it.
+
+    initial holds the register values before the first frame (default: all zero), so
+    long streams can be filled in chunks.
+    """
+    n_frames, n_regs = written.shape
+    # Worked register by register so the running maximum walks contiguous rows
+    rows = np.where(written.T, np.arange(1, n_frames + 1, dtype=np.int32), 0)
+    np.maximum.accumulate(rows, axis=1, out=rows)
+    padded = np.zeros((n_regs, n_frames + 1), dtype=np.uint8)
+    if initial is not None:
+        padded[:, 0] = initial
+    padded[:, 1:] = frame_values.T
+    return np.take_along_axis(padded, rows, axis=1).T.copy()
+
+def from_frame_lists(frames):
+    """(states, written) for frames given as lists of register values, None where not written."""
+    values = np.array([[-1 if v is None else v for v in frame[:PSG_REGS]] for frame in frames], dtype=np.int16).reshape(-1, PSG_REGS)
+    written = values >= 0
+    return carry_forward(np.maximum(values, 0).astype(np.uint8), written), written
+
+def to_frame_lists(states, written):
+    """Inverse of from_frame_lists."""
+    return [[v if w else None for v, w in zip(frame, mask)] for frame, mask in zip(states.tolist(), written.tolist())]
+
+def load_psg(filename):
+    return decode_psg(read_psg(filename))
+
+def raw_frames(states, written):
+    """(n, 16) uint8 frames in the psg2raw layout: R13 | 0x80 when the envelope shape was not written."""
+    raw = np.zeros((len(states), RAW_REGS), dtype=np.uint8)
+    raw[:, :PSG_REGS] = states
+    raw[:, 13] = np.where(written[:, 13], states[:, 13], (states[:, 13] & 0x0f) | 0x80)
+    return raw
+
+def drop_lead_in(states, written):
+    """Drops frame 0 when it is the empty frame before a stream's first 0xff, which RAW frames do not have."""
+    if len(written) and not written[0].any():
+        return states[1:], written[1:]
+    return states, written
+
+def add_lead_in(states, written):
+    """Inverse of drop_lead_in, so the encoded stream opens with 0xff like psg2raw expects."""
+    return (np.vstack((np.zeros((1, states.shape[1]), dtype=np.uint8), states)),
+            np.vstack((np.zeros((1, written.shape[1]), dtype=bool), written)))
+
+def unpack_raw(raw):
+    """Inverse of raw_frames: (states, written) for (n, 16) psg2raw frames.
+
+    RAW frames carry no write information, so every register but R13 counts as written
+    in every frame; R13 counts as written unless it is flagged with 0x80 and unchanged.
+    """
+    raw = np.asarray(raw, dtype=np.uint8)
+    states = raw[:, :PSG_REGS].copy()
+    envelope = raw[:, 13]
+    flagged = (envelope & 0x80) != 0
+    states[:, 13] = np.where(flagged, envelope & 0x0f, envelope)
+    written = np.ones(states.shape, dtype=bool)
+    written[:, 13] = ~flagged
+    written[1:, 13] |= (envelope[1:] & 0x0f) != (states[:-1, 13] & 0x0f)
+    written[0, 13] |= (envelope[0] & 0x0f) != 0
+    return states, written
+
+def changed_writes(states, written):
+    """Drops the writes that leave a register at the value it already has.
+
+    The first write of each register is kept, and so is every R13 write, since
+    writing R13 restarts the envelope even when the shape stays the same.
+    """
+    written_before = np.zeros_like(written)
+    written_before[1:] = np.logical_or.accumulate(written, axis=0)[:-1]
+    changed = np.ones_like(written)
+    changed[1:] = states[1:] != states[:-1]
+    keep = written & (changed | ~written_before)
+    keep[:, 13] = written[:, 13]
+    return keep
+
+def encode_psg(states, written, header=True):
+    """Encodes frames into a PSG file image, the inverse of decode_psg.
+
+    Each frame is its register writes followed by 0xff. Runs of frames with no writes
+    are folded into 0xfe n records of n * 4 frames, with 0xff for the remainder. The
+    whole file is laid out in one preallocated uint8 array, which is returned; with
+    header=False it holds just the command stream, to append to an existing one.
+    """
+    header_size = PSG_HEADER_SIZE if header else 0
+    n_frames = len(states)
+    writes_per_frame = written.sum(axis=1)
+    # Every frame with writes starts a group that also takes the empty frames after it
+    group_starts = np.flatnonzero(writes_per_frame)
+    if n_frames and (len(group_starts) == 0 or group_starts[0] != 0):
+        group_starts = np.concatenate(([0], group_starts))
+    frames_in_group = np.diff(np.append(group_starts, n_frames))
+    skip_records, single_ends = np.divmod(frames_in_group - 1, 4)
+    fe_records = -(-skip_records // 255)
+    group_writes = writes_per_frame[group_starts]
+    group_size = 2 * group_writes + 1 + 2 * fe_records + single_ends
+    group_offset = header_size + np.cumsum(group_size) - group_size
+
+    psg = np.full(header_size + int(group_size.sum()), END_OF_FRAME, dtype=np.uint8)
+    if header:
+        psg[:PSG_HEADER_SIZE] = 0
+        psg[:4] = np.frombuffer(PSG_ID, dtype=np.uint8)
+
+    # Register/value pairs, in register order within each frame
+    frames, regs = np.nonzero(written)
+    pair_offset = np.cumsum(writes_per_frame) - writes_per_frame
+    group_of_frame = np.zeros(n_frames, dtype=np.int64)
+    group_of_frame[group_starts] = 1
+    group_of_frame = np.cumsum(group_of_frame) - 1
+    at = group_offset[group_of_frame[frames]] + 2 * (np.arange(len(frames)) - pair_offset[frames])
+    psg[at] = regs
+    psg[at + 1] = states[frames, regs]
+
+    # 0xfe records right after each group's own 0xff, 255 * 4 frames at most per record
+    groups = np.repeat(np.arange(len(group_starts)), fe_records)
+    record = np.arange(len(groups)) - np.repeat(np.cumsum(fe_records) - fe_records, fe_records)
+    at = group_offset[groups] + 2 * group_writes[groups] + 1 + 2 * record
+    psg[at] = MULTI_END_OF_FRAME
+    psg[at + 1] = np.minimum(skip_records[groups] - 255 * record, 255)
+    return psg
+
+def write_psg(filename, states, written):
+    with open(filename, 'wb') as f:
+        encode_psg(states, written).tofile(f)
+
+def write_psg_chunks(filename, chunks, changes_only=True):
+    """Encodes (states, written) blocks one at a time, by default keeping only the writes that change a register."""
+    previous_states = np.zeros(PSG_REGS, dtype=np.uint8)
+    written_before = np.zeros(PSG_REGS, dtype=bool)
+    with open(filename, 'wb') as f:
+        encode_psg(np.zeros((0, PSG_REGS), dtype=np.uint8), np.zeros((0, PSG_REGS), dtype=bool)).tofile(f)
+        for states, written in chunks:
+            if len(states) == 0:
+                continue
+            # The previous block's last state rides along as frame 0, standing for every write so far
+            if changes_only:
+                written = changed_writes(np.vstack((previous_states, states)), np.vstack((written_before, written)))[1:]
+            encode_psg(states, written, header=False).tofile(f)
+            previous_states = states[-1]
+            written_before |= written.any(axis=0)
@@ -0,0 +1,181 @@
+import argparse
+import json
+import numpy as np
+from psgio import carry_forward, load_psg, write_psg
+from rawio import FRAME_RATE
+
+MIN_FRAMES = 64  # shortest loop or repeated section worth reporting
+DEDUP_SUFFIX = '.dedup.npz'
+HASH_BASE = 0x9e3779b97f4a7c15  # odd, so it has an inverse modulo 2 ** 64
+
+def frame_ids(states, written):
+    """One integer per frame; two frames get the same id when they write the same values to the same registers.
+
+    Registers a frame leaves alone do not count, so a pattern matches its repeats even
+    when some channel still holds a different leftover value.
+    """
+    rows = np.ascontiguousarray(np.hstack((np.where(written, states, 0).astype(np.uint8), np.packbits(written, axis=1))))
+    _, ids = np.unique(rows.view(np.dtype((np.void, rows.shape[1]))).ravel(), return_inverse=True)
+    return ids.ravel().astype(np.uint64)
+
+def hash_powers(base, count):
+    powers = np.ones(count, dtype=np.uint64)
+    powers[1:] = np.cumprod(np.full(count - 1, base, dtype=np.uint64))
+    return powers
+
+def window_hashes(ids, length):
+    """Polynomial hash of ids[i:i + length] for every i, from one prefix sum that wraps modulo 2 ** 64."""
+    n_windows = len(ids) - length + 1
+    if n_windows <= 0:
+        return np.zeros(0, dtype=np.uint64)
+    with np.errstate(over='ignore'):
+        prefix = np.concatenate((np.zeros(1, dtype=np.uint64), np.cumsum((ids + np.uint64(1)) * hash_powers(HASH_BASE, len(ids)), dtype=np.uint64)))
+        # Window i was summed with powers starting at base ** i; scale it back to start at 1
+        return (prefix[length:] - prefix[:n_windows]) * hash_powers(pow(HASH_BASE, -1, 1 << 64), n_windows)
+
+def match_length(ids, source, start, limit):
+    """How many frames from start repeat the ones from source, at most limit; compared in growing blocks."""
+    length = 0
+    block = MIN_FRAMES
+    while length < limit:
+        size = min(block, limit - length)
+        different = np.flatnonzero(ids[source + length:source + length + size] != ids[start + length:start + length + size])
+        if len(different):
+            return length + int(different[0])
+        length += size
+        block *= 2
+    return length
+
+def find_sections(ids, min_frames=MIN_FRAMES):
+    """Splits the frames into (start, length, source) sections, source = -1 for new material.
+
+    A section with a source repeats the frames from source, which end before it starts.
+    Windows of min_frames frames are matched by hash against their first occurrence and
+    then extended frame by frame, so the work is linear in the track length.
+    """
+    n_frames = len(ids)
+    hashes = window_hashes(ids, min_frames)
+    _, first, inverse = np.unique(hashes, return_index=True, return_inverse=True)
+    earlier = first[inverse.ravel()]
+    candidates = np.flatnonzero(earlier + min_frames <= np.arange(len(hashes)))
+    sections = []
+    new_start = position = 0
+    while True:
+        k = np.searchsorted(candidates, position)
+        if k == len(candidates):
+            break
+        start = int(candidates[k])
+        source = int(earlier[start])
+        length = match_length(ids, source, start, min(start - source, n_frames - start))
+        if length < min_frames:
+            # Hash collision
+            position = start + 1
+            continue
+        if start > new_start:
+            sections.append((new_start, start - new_start, -1))
+        sections.append((start, length, source))
+        position = new_start = start + length
+    if new_start < n_frames:
+        sections.append((new_start, n_frames - new_start, -1))
+    return sections
+
+def z_array(sequence):
+    # z[i] = length of the longest common prefix of sequence and sequence[i:]
+    n = len(sequence)
+    z = [0] * n
+    left = right = 0
+    for i in range(1, n):
+        if i < right:
+            z[i] = min(right - i, z[i - left])
+        while i + z[i] < n and sequence[z[i]] == sequence[i + z[i]]:
+            z[i] += 1
+        if i + z[i] > right:
+            left, right = i, i + z[i]
+    return z
+
+def find_loop(ids, min_frames=MIN_FRAMES):
+    """(loop_start, loop_frames, repeat_start), or None when the track does not end in a loop.
+
+    From repeat_start to the end every frame replays the one loop_frames earlier, so the
+    song proper is frames[:repeat_start] with its loop body at [loop_start, repeat_start).
+    """
+    if len(ids) <= min_frames:
+        return None
+    # Matching the reversed frames against themselves finds the longest tail that repeats
+    z = np.array(z_array(ids[::-1].tolist()))
+    z[:min_frames] = 0
+    loop_frames = int(np.argmax(z))
+    if z[loop_frames] < min_frames:
+        return None
+    repeat_start = len(ids) - int(z[loop_frames])
+    return repeat_start - loop_frames, loop_frames, repeat_start
+
+def dedupe(states, written, sections):
+    """The frames of the new sections only; restore() rebuilds the rest from the sections and their writes."""
+    new = [np.arange(start, start + length) for start, length, source in sections if source < 0]
+    new = np.concatenate(new) if new else np.zeros(0, dtype=np.int64)
+    return states[new], written[new]
+
+def restore(sections, states, written):
+    n_frames = sum(length for start, length, source in sections)
+    full_states = np.zeros((n_frames, states.shape[1]), dtype=states.dtype)
+    full_written = np.zeros((n_frames, written.shape[1]), dtype=bool)
+    used = 0
+    for start, length, source in sections:
+        if source < 0:
+            full_states[start:start + length] = states[used:used + length]
+            full_written[start:start + length] = written[used:used + length]
+            used += length
+        else:
+            full_states[start:start + length] = full_states[source:source + length]
+            full_written[start:start + length] = full_written[source:source + length]
+    # Only the writes are repeated exactly; the state in between comes from what was written before
+    return carry_forward(full_states, full_written), full_written
+
+def save_dedup(filename, states, written, sections):
+    np.savez_compressed(filename, sections=np.array(sections, dtype=np.int64).reshape(-1, 3), states=states, written=written)
+
+def load_dedup(filename):
+    with np.load(filename) as dedup:
+        return restore(dedup['sections'].tolist(), dedup['states'], dedup['written'])
+
+def analyze(states, written, min_frames=MIN_FRAMES):
+    ids = frame_ids(states, written)
+    return find_loop(ids, min_frames), find_sections(ids, min_frames)
+
+def report(n_frames, loop, sections):
+    lines = [f"{n_frames} frames ({n_frames / FRAME_RATE:.1f} s)"]
+    if loop:
+        loop_start, loop_frames, repeat_start = loop
+        lines.append(f"loop: frames {loop_start}-{repeat_start - 1} ({loop_frames / FRAME_RATE:.1f} s), replayed from frame {repeat_start} to the end")
+    else:
+        lines.append("loop: none")
+    for start, length, source in sections:
+        origin = "new" if source < 0 else f"repeats {source}-{source + length - 1}"
+        lines.append(f"  {start}-{start + length - 1}: {origin}")
+    return '\n'.join(lines)
+
+def main(args):
+    states, written = load_psg(args.input_filename)
+    loop, sections = analyze(states, written, args.min_frames)
+    if args.json:
+        keys = ('loop_start', 'loop_frames', 'repeat_start')
+        print(json.dumps({'frames': len(states), 'loop': dict(zip(keys, loop)) if loop else None,
+                          'sections': [dict(zip(('start', 'length', 'source'), section)) for section in sections]}))
+    else:
+        print(report(len(states), loop, sections))
+    if args.trim:
+        end = loop[2] if loop else len(states)
+        write_psg(args.trim, states[:end], written[:end])
+    if args.dedup:
+        save_dedup(args.dedup, *dedupe(states, written, sections), sections)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Find the loop point and repeated sections of a PSG file.')
+    parser.add_argument('input_filename', help='The input PSG file')
+    parser.add_argument('--min-frames', type=int, default=MIN_FRAMES, help=f'Shortest loop or repeated section to report (default: {MIN_FRAMES})')
+    parser.add_argument('--json', action='store_true', help='Print the loop and sections as JSON')
+    parser.add_argument('--trim', metavar='PSG', help='Write the song up to where the loop starts replaying')
+    parser.add_argument('--dedup', metavar='NPZ', help=f'Save the new sections and the section list (conventionally <input>{DEDUP_SUFFIX})')
+    args = parser.parse_args()
+    main(args)
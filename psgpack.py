@@ -0,0 +1,93 @@
+import argparse
+import os
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from batch import find_inputs
+from psgio import PSG_REGS, USED_BITS, changed_writes, encode_psg, load_psg
+
+PACKED_SUFFIX = '.min.psg'
+VOLUMES = slice(8, 11)
+ENVELOPE = slice(11, 14)  # period and shape; the envelope keeps running through silence
+ENVELOPE_MODE = 0x10  # volume register bit that hands the channel to the envelope
+
+def useful_envelope_writes(states, written):
+    """The R13 writes that can be heard: some channel uses the envelope before the next R13 write restarts it."""
+    envelope_on = (states[:, VOLUMES] & ENVELOPE_MODE).any(axis=1)
+    used_before = np.concatenate(([0], np.cumsum(envelope_on)))
+    writes = np.flatnonzero(written[:, 13])
+    ends = np.append(writes[1:], len(states))
+    keep = np.zeros(len(states), dtype=bool)
+    keep[writes] = used_before[ends] > used_before[writes]
+    return keep
+
+def hold_silence(states, written):
+    """Moves the writes made while all three channels are silent onto the first frame that sounds again.
+
+    Volumes and the envelope registers still change where they did: an R13 write restarts
+    the envelope, and its period sets how far it has run by the time the sound comes back.
+    The output is the same while silent, but the tone and noise counters run on the old
+    periods until then, so their phases can differ afterwards and the result is not
+    sample-exact.
+    """
+    n_frames = len(states)
+    silent = ((states[:, VOLUMES] & 0x1f) == 0).all(axis=1)
+    index = np.arange(n_frames)
+    last_sounding = np.maximum.accumulate(np.where(silent, -1, index))
+    next_sounding = np.minimum.accumulate(np.where(silent, n_frames, index)[::-1])[::-1]
+    held = np.vstack((np.zeros((1, PSG_REGS), dtype=np.uint8), states))[last_sounding + 1]
+    held[:, VOLUMES] = states[:, VOLUMES]
+    held[:, ENVELOPE] = states[:, ENVELOPE]
+
+    moved = written & silent[:, None]
+    moved[:, VOLUMES] = False
+    moved[:, ENVELOPE] = False
+    frames, regs = np.nonzero(moved)
+    written = written & ~moved
+    # A silence that runs to the end of the song drops its writes; the target frame's state is the last value written
+    to_sound = next_sounding[frames] < n_frames
+    written[next_sounding[frames[to_sound]], regs[to_sound]] = True
+    return held, written
+
+def pack_frames(states, written, exact=False):
+    """(states, written) with only the writes that change what the chip plays."""
+    if not exact:
+        states, written = hold_silence(states, written)
+    keep = changed_writes(states & USED_BITS, written)
+    keep[:, 13] = useful_envelope_writes(states, written)
+    return states, keep
+
+def pack_file(input_filename, output_filename, exact=False):
+    """Recompresses one PSG file. Returns the (input, output) sizes in bytes."""
+    data = encode_psg(*pack_frames(*load_psg(input_filename), exact))
+    data.tofile(output_filename)
+    return os.path.getsize(input_filename), len(data)
+
+def find_psg_files(paths):
+    filenames = []
+    for path in paths:
+        if os.path.isdir(path):
+            filenames += [os.path.join(path, name) for name in find_inputs(path, ('.psg',)) if not name.endswith(PACKED_SUFFIX)]
+        else:
+            filenames.append(path)
+    return filenames
+
+def main(args):
+    filenames = find_psg_files(args.paths)
+    total_in = total_out = 0
+    with ProcessPoolExecutor(max_workers=args.jobs) as executor:
+        outputs = [filename + args.suffix for filename in filenames]
+        for filename, (in_size, out_size) in zip(filenames, executor.map(pack_file, filenames, outputs, [args.exact] * len(filenames))):
+            total_in += in_size
+            total_out += out_size
+            print(f"{filename}: {in_size} -> {out_size} bytes ({out_size / max(in_size, 1):.1%})")
+    if len(filenames) > 1:
+        print(f"total: {total_in} -> {total_out} bytes ({total_out / max(total_in, 1):.1%})")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Recompress PSG files, keeping only the register writes that change what the chip plays.')
+    parser.add_argument('paths', nargs='+', help='PSG files, or folders to scan recursively for .psg files')
+    parser.add_argument('--suffix', default=PACKED_SUFFIX, help=f'Appended to each input filename for its output (default: {PACKED_SUFFIX})')
+    parser.add_argument('--exact', action='store_true', help='Keep writes made during silence, so the output renders sample for sample like the input')
+    parser.add_argument('--jobs', type=int, help='Worker processes (default: one per CPU)')
+    args = parser.parse_args()
+    main(args)
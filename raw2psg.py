@@ -1,7 +1,7 @@
 #!/usr/local/bin/python3
-from array import array
 import sys
-import struct
+import numpy as np
+from psgio import add_lead_in, changed_writes, encode_psg, unpack_raw
 
 PSG1_ID = b'PSG\x1A'
 PSG1_HEAD = b'\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00' 
@@ -21,26 +21,9 @@ class Raw:
         return self.raw
 
     def convert_to_PSG1(self):
-        ay = bytearray(16)
-        self.psg = self.psg + PSG1_ID + PSG1_HEAD
-        prevR13 = self.raw[13]; 
-        for i in range(0,len(self.raw),RAW_REGS):
-            self.psg.append(0xff) #new frame
-            ay = self.raw[i:i+PSG1_REGS]
-            c_reg = 0
-            if ((ay[13] & 0x80) != 0 ) and (prevR13 & 0x0f == ay[13] & 0xf):
-                for r in ay[:13]:
-                    self.psg.append(c_reg)
-                    self.psg.append(r)
-                    c_reg += 1
-            else:
-                ay[13] = ay[13] & 0x0f
-                for r in ay[:PSG1_REGS]:
-                    self.psg.append(c_reg)
-                    self.psg.append(r)
-                    c_reg += 1
-            prevR13 = ay[13]
-        self.psg.append(0xfd) #end of music
+        states, written = unpack_raw(np.frombuffer(self.raw, dtype=np.uint8).reshape(-1, RAW_REGS))
+        states, written = add_lead_in(states, written)
+        self.psg = bytearray(encode_psg(states, changed_writes(states, written)))
         return self.psg
 
     def save_psg(self, filename):
@@ -49,16 +32,14 @@ class Raw:
             f.write(self.psg)
         return filename
 
-if len(sys.argv) == 3:
-    infile = sys.argv[1]
-    outfile = sys.argv[2]
-    #print("in: ", infile )
-    #print("out: ", outfile )
-    raw = Raw(infile)
-    raw.load()
-    raw.convert_to_PSG1()
-    raw.save_psg(outfile)
-else:
-    print ("Please specify in- and out- file:")
-    print (">raw2psg in.raw out.psg")
-    #print (sys.argv)
\ No newline at end of file
+if __name__ == "__main__":
+    if len(sys.argv) == 3:
+        infile = sys.argv[1]
+        outfile = sys.argv[2]
+        raw = Raw(infile)
+        raw.load()
+        raw.convert_to_PSG1()
+        raw.save_psg(outfile)
+    else:
+        print ("Please specify in- and out- file:")
+        print (">raw2psg in.raw out.psg")
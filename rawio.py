@@ -0,0 +1,32 @@
+import os
+import numpy as np
+
+RAW_REGS = 16
+FRAME_RATE = 50
+
+def open_raw(filename):
+    """Memory-maps a psg2raw file as a read-only (n_frames, 16) uint8 array.
+
+    Nothing is read up front: slicing frames or taking a register column gives views
+    into the mapping, and only the pages those views touch are ever loaded.
+    """
+    n_frames = os.path.getsize(filename) // RAW_REGS
+    if n_frames == 0:
+        # Empty files cannot be mapped
+        return np.zeros((0, RAW_REGS), dtype=np.uint8)
+    return np.memmap(filename, dtype=np.uint8, mode='r', shape=(n_frames, RAW_REGS))
+
+def frame_range(frames, start_seconds, end_seconds=None, frame_rate=FRAME_RATE):
+    """View of the frames played from start_seconds up to end_seconds (default: the end)."""
+    start = int(start_seconds * frame_rate)
+    end = len(frames) if end_seconds is None else int(end_seconds * frame_rate)
+    return frames[start:end]
+
+def register_column(frames, reg):
+    """Strided view of one register across all frames, e.g. register_column(frames, 13) for the envelope shapes."""
+    return frames[:, reg]
+
+def save_raw(filename, frames):
+    """Writes (n_frames, 16) uint8 frames back out in the psg2raw layout."""
+    with open(filename, 'wb') as f:
+        np.ascontiguousarray(frames, dtype=np.uint8).tofile(f)
@@ -0,0 +1,117 @@
+import argparse
+import os
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from aydump import concatenate_chunks
+from batch import find_inputs
+from pipeline import READERS, WRITERS, file_type, run
+from psgio import PSG_REGS, drop_lead_in
+
+# Frames are compared on what the chip plays: every register state, plus whether R13 was
+# written, since a write restarts the envelope even when the shape stays the same
+REGISTER_NAMES = tuple(f'R{reg}' for reg in range(PSG_REGS)) + ('R13 write',)
+CHAIN = ('raw', 'psg', 'aydump', 'psg')
+
+def load_frames(filename):
+    """(n, 15) uint8 frames of any pipeline input: the 14 register states and the R13 write flag, without the lead-in."""
+    # Numbered copies such as sync.psg.aydump.psg.aydump.2 read like the name before the number
+    base, extension = os.path.splitext(filename)
+    reader = READERS[file_type(base if extension[1:].isdigit() else filename, READERS)]
+    states, written = drop_lead_in(*concatenate_chunks(reader(filename)))
+    return np.hstack((states, written[:, 13:14].astype(np.uint8)))
+
+def diff_frames(expected, actual):
+    """Compares two frame matrices over the frames both have.
+
+    Returns a dict with the two frame counts, the first divergent (frame, register name),
+    or (frame, None) when one just ends early, or None when they match, and the
+    mismatch count for every register that has any.
+    """
+    n_frames = min(len(expected), len(actual))
+    different = expected[:n_frames] != actual[:n_frames]
+    counts = np.count_nonzero(different, axis=0)
+    rows = np.flatnonzero(different.any(axis=1))
+    if len(rows):
+        first = (int(rows[0]), REGISTER_NAMES[int(np.argmax(different[rows[0]]))])
+    elif len(expected) != len(actual):
+        first = (n_frames, None)
+    else:
+        first = None
+    return {'frames': (len(expected), len(actual)), 'first': first,
+            'mismatches': {REGISTER_NAMES[reg]: int(count) for reg, count in enumerate(counts) if count}}
+
+def describe(diff):
+    if diff['first'] is None:
+        return "ok"
+    frame, register = diff['first']
+    text = f"frames {diff['frames'][0]} vs {diff['frames'][1]}" if register is None else f"first difference at frame {frame} {register}"
+    if diff['mismatches']:
+        text += "; mismatches " + ', '.join(f"{name}: {count}" for name, count in diff['mismatches'].items())
+    return text
+
+def verify_file(filename, chain=CHAIN):
+    """Converts filename through every format in chain in turn, comparing each result with the original.
+
+    Returns [(format, seconds, input bytes, frames, diff)], one entry per stage.
+    """
+    expected = load_frames(filename)
+    stages = []
+    with tempfile.TemporaryDirectory() as work_dir:
+        current = filename
+        for i, extension in enumerate(chain):
+            output = os.path.join(work_dir, f'{i}.{extension}')
+            start = time.perf_counter()
+            run(current, output)
+            seconds = time.perf_counter() - start
+            stages.append((extension, seconds, os.path.getsize(current), len(expected), diff_frames(expected, load_frames(output))))
+            current = output
+    return stages
+
+def find_files(paths):
+    extensions = tuple(READERS)
+    filenames = []
+    for path in paths:
+        if os.path.isdir(path):
+            filenames += [os.path.join(path, name) for name in find_inputs(path, extensions)]
+        else:
+            filenames.append(path)
+    return filenames
+
+def main(args):
+    if args.diff:
+        if len(args.paths) != 2:
+            raise SystemExit("--diff takes two files")
+        diff = diff_frames(load_frames(args.paths[0]), load_frames(args.paths[1]))
+        print(describe(diff))
+        sys.exit(diff['first'] is not None)
+
+    filenames = find_files(args.paths)
+    totals = [[0.0, 0, 0] for _ in args.chain]
+    failed = 0
+    with ProcessPoolExecutor(max_workers=args.jobs) as executor:
+        for filename, stages in zip(filenames, executor.map(verify_file, filenames, [args.chain] * len(filenames))):
+            print(f"{filename}: " + ', '.join(f"{extension} {describe(diff)}" for extension, _, _, _, diff in stages))
+            failed += any(diff['first'] is not None for *_, diff in stages)
+            for total, (_, seconds, size, frames, _) in zip(totals, stages):
+                total[0] += seconds
+                total[1] += size
+                total[2] += frames
+    # Stage times are summed over the workers, so this is per-process throughput
+    for extension, (seconds, size, frames) in zip(args.chain, totals):
+        if seconds:
+            print(f"to {extension}: {frames / seconds:.0f} frames/s, {size / seconds / 1e6:.1f} MB/s read")
+    print(f"{len(filenames) - failed} of {len(filenames)} files round-trip cleanly")
+    sys.exit(failed > 0)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Check conversion round trips: convert every file through a chain of formats and compare the frames after each step.')
+    parser.add_argument('paths', nargs='+', help='Files in any pipeline input format, or folders to scan recursively')
+    parser.add_argument('--chain', nargs='+', default=list(CHAIN), choices=[extension[1:] for extension in WRITERS if extension in READERS],
+                        help=f"Formats to convert through, in order (default: {' '.join(CHAIN)})")
+    parser.add_argument('--diff', action='store_true', help='Just compare the frames of two files')
+    parser.add_argument('--jobs', type=int, help='Worker processes (default: one per CPU)')
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,141 @@
+import argparse
+import os
+import struct
+import numpy as np
+from lh5 import compress, decompress, is_lha, read_lha, write_lha
+from psgio import PSG_REGS, USED_BITS, add_lead_in, carry_forward, drop_lead_in
+
+# YM and VTX files store the registers interleaved: all frames of R0, then all frames
+# of R1 and so on. Every register is set every frame except R13, where 0xff means the
+# envelope is left alone. Frames come back in the decode_psg numbering, lead-in included.
+NOT_WRITTEN = 0xff
+YM_REGS = 16  # YM5/YM6 also store R14 and R15
+YM_CHECK = b'LeOnArD!'
+YM_HEADER = struct.Struct('>4s8sIIHIHIH')  # id, check, frames, attributes, digidrums, clock, frame rate, loop frame, extra data size
+YM_INTERLEAVED = 0x01  # attribute bit; without it the frames are stored one after another
+YM_END = b'End!'
+YM_STRINGS = ('title', 'author', 'comment')
+VTX_HEADER = struct.Struct('<2sBHIBHI')  # chip, stereo, loop frame, clock, frame rate, year, unpacked size
+VTX_STRINGS = ('title', 'author', 'program', 'editor', 'comment')
+VTX_ABC = 1  # stereo layout
+DEFAULT_INFO = {'clock': 1773400, 'frame_rate': 50, 'loop_frame': 0}
+
+def unpack_frames(frames):
+    """(states, written) for (n, 14+) YM/VTX register frames.
+
+    YM5/YM6 special effects live in register bits the chip does not use; they are masked off.
+    """
+    frames = np.asarray(frames[:, :PSG_REGS], dtype=np.uint8)
+    written = np.ones(frames.shape, dtype=bool)
+    written[:, 13] = frames[:, 13] != NOT_WRITTEN
+    return add_lead_in(carry_forward(frames & USED_BITS, written), written)
+
+def pack_frames(states, written, n_regs=PSG_REGS):
+    """Inverse of unpack_frames: (n, n_regs) register frames with R13 = 0xff where it was not written."""
+    states, written = drop_lead_in(states, written)
+    frames = np.zeros((len(states), n_regs), dtype=np.uint8)
+    frames[:, :PSG_REGS] = states
+    frames[:, 13] = np.where(written[:, 13], states[:, 13], NOT_WRITTEN)
+    return frames
+
+def deinterleave(data, n_regs, n_frames):
+    registers = np.frombuffer(data, dtype=np.uint8, count=n_regs * n_frames)
+    return registers.reshape(n_regs, n_frames).T
+
+def read_strings(data, pos, names):
+    info = {}
+    for name in names:
+        end = data.index(b'\x00', pos)
+        info[name] = bytes(data[pos:end]).decode('latin-1')
+        pos = end + 1
+    return info, pos
+
+def write_strings(info, names):
+    return b''.join(info.get(name, '').encode('latin-1', 'replace') + b'\x00' for name in names)
+
+def decode_ym(data):
+    """(states, written, info) for a YM2/YM3/YM3b/YM5/YM6 file image, LHA-packed or not."""
+    if is_lha(data):
+        data = read_lha(data)[0][1]
+    magic = bytes(data[:4])
+    info = dict(DEFAULT_INFO, format=magic.decode('latin-1').rstrip('!'))
+    if magic in (b'YM2!', b'YM3!', b'YM3b'):
+        body = data[4:]
+        if magic == b'YM3b':
+            info['loop_frame'], = struct.unpack('<I', body[-4:])
+            body = body[:-4]
+        frames = deinterleave(body, PSG_REGS, len(body) // PSG_REGS)
+    elif magic in (b'YM5!', b'YM6!'):
+        _, check, n_frames, attributes, digidrums, info['clock'], info['frame_rate'], info['loop_frame'], extra = YM_HEADER.unpack_from(data)
+        if check != YM_CHECK:
+            raise ValueError("Not a valid YM file")
+        pos = YM_HEADER.size + extra
+        for _ in range(digidrums):
+            size, = struct.unpack_from('>I', data, pos)
+            pos += 4 + size
+        strings, pos = read_strings(data, pos, YM_STRINGS)
+        info.update(strings)
+        body = data[pos:pos + YM_REGS * n_frames]
+        if len(body) < YM_REGS * n_frames:
+            raise ValueError("Truncated YM file")
+        if attributes & YM_INTERLEAVED:
+            frames = deinterleave(body, YM_REGS, n_frames)
+        else:
+            frames = np.frombuffer(body, dtype=np.uint8).reshape(n_frames, YM_REGS)
+    else:
+        raise ValueError("Not a valid YM file")
+    return (*unpack_frames(frames), info)
+
+def encode_ym(states, written, info=None, name='song.ym', packed=True):
+    """A YM5 file image, interleaved, in a one-member LHA archive unless packed=False."""
+    info = dict(DEFAULT_INFO, **(info or {}))
+    frames = pack_frames(states, written, YM_REGS)
+    data = (YM_HEADER.pack(b'YM5!', YM_CHECK, len(frames), YM_INTERLEAVED, 0, info['clock'], info['frame_rate'], info['loop_frame'], 0)
+            + write_strings(info, YM_STRINGS) + frames.T.tobytes() + YM_END)
+    return write_lha(name, data) if packed else data
+
+def decode_vtx(data):
+    """(states, written, info) for a VTX file image."""
+    chip, stereo, loop_frame, clock, frame_rate, year, size = VTX_HEADER.unpack_from(data)
+    if chip.lower() not in (b'ay', b'ym'):
+        raise ValueError("Not a valid VTX file")
+    info, pos = read_strings(data, VTX_HEADER.size, VTX_STRINGS)
+    info.update(format='vtx', chip=chip.decode('latin-1').lower(), stereo=stereo, clock=clock, frame_rate=frame_rate, loop_frame=loop_frame, year=year)
+    registers = decompress(data[pos:], size)
+    return (*unpack_frames(deinterleave(registers, PSG_REGS, size // PSG_REGS)), info)
+
+def encode_vtx(states, written, info=None):
+    info = dict(DEFAULT_INFO, **(info or {}))
+    registers = pack_frames(states, written).T.tobytes()
+    header = VTX_HEADER.pack(info.get('chip', 'ay').encode('latin-1'), info.get('stereo', VTX_ABC), info['loop_frame'], info['clock'],
+                             info['frame_rate'], info.get('year', 0), len(registers))
+    return header + write_strings(info, VTX_STRINGS) + compress(registers)
+
+def load_ym(filename):
+    with open(filename, 'rb') as f:
+        return decode_ym(f.read())
+
+def save_ym(filename, states, written, info=None, packed=True):
+    with open(filename, 'wb') as f:
+        f.write(encode_ym(states, written, info, os.path.basename(filename), packed))
+
+def load_vtx(filename):
+    with open(filename, 'rb') as f:
+        return decode_vtx(f.read())
+
+def save_vtx(filename, states, written, info=None):
+    with open(filename, 'wb') as f:
+        f.write(encode_vtx(states, written, info))
+
+def main(filenames):
+    for filename in filenames:
+        load = load_vtx if filename.lower().endswith('.vtx') else load_ym
+        states, written, info = load(filename)
+        details = ', '.join(f"{key}: {value}" for key, value in info.items() if value not in ('', None))
+        print(f"{filename}: {len(states) - 1} frames, {details}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Show what is in YM and VTX files; pipeline.py converts them to and from the other formats.')
+    parser.add_argument('filenames', nargs='+', help='YM (packed or not) and VTX files')
+    args = parser.parse_args()
+    main(args.filenames)